@@ -42,6 +42,8 @@ HTTPR = 'httpr'
 EMPTYSTRING = ''
 --- CDR
 CDRTTL = tonumber(os.getenv('CDRTTL')) or 3600  -- configurable via env var; increase (e.g. 172800) to prevent silent CDR loss on liberator downtime
+CDR_TRANSPORT = (os.getenv('CDR_TRANSPORT') or 'list'):lower()                 -- list: cdr:queue:new + cdr:detail, stream: cdr:stream
+CDR_STREAM_MAXLEN = tonumber(os.getenv('CDR_STREAM_MAXLEN')) or 1000000         -- approximate cap of cdr:stream length
 
 --- SECURITY
 ROLLING_WINDOW_TIME = 1000                             --- use the exactly 1 second = 1000ms
@@ -10,6 +10,11 @@
 require("callng.utilities")
 -- ------------------------------------------------------------------------------------------------------------------------------------------------
 
+-- the redis client has no stream command, XADD is done by script
+local cdrstreamadd = [[
+    return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'uuid', ARGV[2], 'detail', ARGV[3])
+]]
+
 local function cdrreport()
     local uuid = event:getHeader("Unique-ID")
     local seshid = event:getHeader("variable_X-LIBRE-SESHID")
@@ -106,10 +111,14 @@ local function cdrreport()
     -- push raw cdr to redis, may use "event:serialize('json')" if needed
     cdrjson = json.encode(cdr_details)
     if rdbstate then
-        rdbconn:pipeline(function(pipe)
-            pipe:rpush('cdr:queue:new', uuid)
-            pipe:setex('cdr:detail:'..uuid, CDRTTL, cdrjson)
-        end)
+        if CDR_TRANSPORT == 'stream' then
+            rdbconn:eval(cdrstreamadd, 1, 'cdr:stream', CDR_STREAM_MAXLEN, uuid, cdrjson)
+        else
+            rdbconn:pipeline(function(pipe)
+                pipe:rpush('cdr:queue:new', uuid)
+                pipe:setex('cdr:detail:'..uuid, CDRTTL, cdrjson)
+            end)
+        end
     else
         filename = os.date("%Y-%m-%d")..'.cdr.raw.json'
         writefile(LOGDIR..'/cdr/'..filename, cdrjson)
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
+import os
+import sys
 from sys import argv
 import traceback
 from datetime import datetime
-import json
+import gzip
+import io
+import zstandard
+# decode as liberator does, with the fast backend when available
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'liberator'))
+from jsoncodec import loads as jsonloads
 
 
 _COMMA_ = ','
@@ -74,20 +81,41 @@ def csvline(cdrs):
         print(f'[error] \ncdrs={cdrs}, \nexception={e}, traceback={traceback.format_exc()}')
 
 
+def jsonreader(jsonfile):
+    # plain, gzip (.json.gz) or zstd (.json.zst) cdr file, decompressed while reading
+    if jsonfile.endswith('.gz'):
+        return gzip.open(jsonfile, 'rt')
+    if jsonfile.endswith('.zst'):
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(jsonfile, 'rb'), read_across_frames=True, closefd=True))
+    return open(jsonfile, 'r')
+
+
 def run(jsonfile, csvfile=None):
     if not csvfile:
-        csvfile = f'{jsonfile[:-5]}.csv'
-
-    with open(jsonfile, 'r') as reader, open(csvfile, 'w') as writer:
+        # 2024-01-01.cdr.nice.json.gz -> 2024-01-01.cdr.nice.csv, any other name just get .csv
+        basename, extension = os.path.splitext(jsonfile)
+        if extension in ('.gz', '.zst'):
+            basename, extension = os.path.splitext(basename)
+        if extension != '.json':
+            basename = f'{basename}{extension}'
+        csvfile = f'{basename}.csv'
+
+    with jsonreader(jsonfile) as reader, open(csvfile, 'w') as writer:
         begin = True
-        for line in reader.readlines():
-            if begin:
-                hdr = csvheader()
-                writer.writelines(hdr)
-                begin = False
-            cdr = json.loads(line)
-            row = csvline(cdr)
-            writer.writelines(row)
+        try:
+            for line in reader:
+                if begin:
+                    hdr = csvheader()
+                    writer.writelines(hdr)
+                    begin = False
+                # last frame of a file being written may be incomplete
+                if not line.endswith('\n'): break
+                cdr = jsonloads(line)
+                row = csvline(cdr)
+                writer.writelines(row)
+        # truncated gzip member or zstd frame of a file being written
+        except (EOFError, zstandard.ZstdError):
+            pass
 
 
 if __name__ == '__main__':
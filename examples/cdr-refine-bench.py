@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of cdr refinement, legacy dict builder versus table-driven CDRRecord
+Usage:: cdr-refine-bench.py [<number of cdr>]
+"""
+import os
+import sys
+import time
+import json
+import random
+from sys import argv
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'liberator'))
+os.environ.setdefault('LOGSTACKS', 'CONSOLE')
+from cdr import SIP_DISPOSITIONS, parseruri, cdrrefine
+
+
+def fmtime(epochtime):
+    try:
+        epochtime = float(epochtime)
+        if epochtime == 0: None
+        else: return datetime.fromtimestamp(epochtime, tz=timezone.utc).isoformat()
+    except:
+        return None
+
+
+def legacyrefine(details):
+    # CDRHandler.refine before the table-driven CDRRecord
+    uuid = details.get('uuid')
+    seshid = details.get('seshid')
+    direction = details.get('direction')
+    sipprofile = details.get('sipprofile')
+    context = details.get('context')
+    nodeid = details.get('nodeid')
+    intconname = details.get('intconname')
+    gateway = details.get('gateway_name')
+    user_agent = details.get('user_agent')
+    callid = details.get('callid')
+    caller_name = details.get('caller_name')
+    caller_number = details.get('caller_number')
+    destination_number = details.get('destination_number')
+    start_time = fmtime(details.get('start_time'))
+    answer_time  = fmtime(details.get('answer_time'))
+    end_time = fmtime(details.get('end_time'))
+    progress_time = fmtime(details.get('progress_time'))
+    progress_media_time = fmtime(details.get('progress_media_time'))
+    duration = details.get('duration', 0)
+    sip_network_ip = details.get('sip_network_ip')
+    sip_network_port = details.get('sip_network_port')
+    sip_local_network_addr = details.get('sip_local_network_addr')
+    sip_req_uri = details.get('sip_req_uri')
+    access_authid = details.get('access_authid')
+    access_srcip = details.get('access_srcip')
+    access_userid = details.get('access_userid')
+    transport = 'udp'
+    if direction.lower() == 'inbound':
+        sip_via_protocol = details.get('sip_via_protocol')
+        if sip_via_protocol: transport = sip_via_protocol
+    else:
+        ruri_host, ruri_port, ruri_transport = parseruri(sip_req_uri)
+        if ruri_transport: transport = ruri_transport
+    remote_media_ip = details.get('remote_media_ip')
+    remote_media_port = details.get('remote_media_port')
+    local_media_ip = details.get('local_media_ip')
+    local_media_port = details.get('local_media_port')
+    read_codec = details.get('read_codec')
+    write_codec = details.get('write_codec')
+    rtp_crypto = details.get('rtp_has_crypto')
+    hangup_cause = details.get('hangup_cause')
+    libre_hangup_cause = details.get('libre_hangup_cause')
+    if libre_hangup_cause:
+        hangup_cause = f'{hangup_cause}_BY_{libre_hangup_cause}'
+    hangup_disposition = details.get('hangup_disposition')
+    disposition = f'LIBRESBC_{hangup_disposition.upper()}' if hangup_disposition else 'UNDEFINED'
+    sip_hangup_cause = details.get('sip_hangup_cause')
+    bridge_sip_hangup_cause = details.get('bridge_sip_hangup_cause')
+    libre_sip_hangup_cause = details.get('libre_sip_hangup_cause')
+    sip_redirected_to = details.get('sip_redirected_to')
+    if sip_hangup_cause: sip_resp_code = sip_hangup_cause
+    elif bridge_sip_hangup_cause: sip_resp_code = bridge_sip_hangup_cause
+    elif libre_sip_hangup_cause: sip_resp_code = libre_sip_hangup_cause
+    else:
+        if duration and duration.isdigit() and int(duration) > 0: sip_resp_code = 'sip:200'
+        elif sip_redirected_to: sip_resp_code = 'sip:302'
+        else: sip_resp_code = 'sip:000'
+    status = SIP_DISPOSITIONS.get(int(sip_resp_code.split(':')[1]), 'FAILURE')
+
+    cdrdata = {
+        'uuid': uuid, 'seshid': seshid, 'direction': direction, 'sipprofile': sipprofile, 'context': context,
+        'nodeid': nodeid, 'intconname': intconname, 'gateway': gateway, 'user_agent': user_agent, 'callid': callid,
+        'caller_name': caller_name, 'caller_number': caller_number, 'destination_number': destination_number,
+        'start_time': start_time, 'answer_time': answer_time, 'end_time': end_time, 'progress_time': progress_time,
+        'progress_media_time': progress_media_time, 'duration': duration, 'sip_network_ip': sip_network_ip,
+        'sip_network_port': sip_network_port, 'sip_local_network_addr': sip_local_network_addr, 'transport': transport,
+        'remote_media_ip': remote_media_ip, 'remote_media_port': remote_media_port, 'local_media_ip': local_media_ip,
+        'local_media_port': local_media_port, 'read_codec': read_codec, 'write_codec': write_codec, 'rtp_crypto': rtp_crypto,
+        'hangup_cause': hangup_cause, 'sip_resp_code' : sip_resp_code, 'disposition': disposition, 'status': status,
+    }
+    if access_authid: cdrdata['access_authid'] = access_authid
+    if access_srcip: cdrdata['access_srcip'] = access_srcip
+    if access_userid: cdrdata['access_userid'] = access_userid
+    return cdrdata
+
+
+def sample(index):
+    start = 1700000000 + index*7
+    answered = random.random() < 0.6
+    direction = random.choice(['inbound', 'outbound'])
+    details = {
+        'uuid': f'00000000-0000-0000-0000-{index:012d}', 'seshid': f'00000000-0000-0000-0000-{index:012d}',
+        'direction': direction, 'sipprofile': 'public', 'context': 'core', 'nodeid': 'libresbc01', 'intconname': 'carrier',
+        'gateway_name': 'gateway01', 'user_agent': 'LibreSBC', 'callid': f'{index}@10.0.0.1', 'caller_name': 'libre',
+        'caller_number': '84987654321', 'destination_number': '84123456789',
+        'start_time': str(start), 'answer_time': str(start+3) if answered else '0', 'end_time': str(start+63),
+        'progress_time': str(start+1), 'progress_media_time': '0', 'duration': '60' if answered else '0',
+        'sip_network_ip': '10.0.0.1', 'sip_network_port': '5060', 'sip_local_network_addr': '10.0.0.2',
+        'sip_via_protocol': 'udp', 'sip_req_uri': 'sip:84123456789@10.0.0.3:5060;transport=tcp',
+        'remote_media_ip': '10.0.0.1', 'remote_media_port': '16384', 'local_media_ip': '10.0.0.2', 'local_media_port': '20000',
+        'read_codec': 'PCMA', 'write_codec': 'PCMA', 'rtp_has_crypto': None,
+        'hangup_cause': random.choice(['NORMAL_CLEARING', 'ORIGINATOR_CANCEL', 'USER_BUSY']),
+        'hangup_disposition': random.choice(['recv_bye', 'send_bye', 'recv_cancel']),
+    }
+    if not answered:
+        details['sip_hangup_cause'] = random.choice(['sip:486', 'sip:487', 'sip:503', 'sip:404'])
+    if index % 10 == 0:
+        details['access_authid'] = 'user01'
+        details['access_srcip'] = '10.0.0.9'
+    return details
+
+
+def bench(refine, cdrs):
+    # cpu time of a single thread, that is cdr per second per core
+    start = time.process_time()
+    for details in cdrs: refine(details)
+    return len(cdrs) / (time.process_time() - start)
+
+
+if __name__ == '__main__':
+    number = int(argv[1]) if len(argv) == 2 else 100000
+    cdrs = [sample(index) for index in range(number)]
+    # both refinements must produce the same json document
+    for details in cdrs:
+        assert json.dumps(cdrrefine(details).asdict()) == json.dumps(legacyrefine(details)), details['uuid']
+    before = bench(legacyrefine, cdrs)
+    after = bench(cdrrefine, cdrs)
+    print(f'cdr={number}, before={round(before)} cdr/s/core, after={round(after)} cdr/s/core, speedup={round(after/before, 2)}x')
@@ -7,22 +7,50 @@
 # All Rights Reserved.
 #
 
+import os
 import time
 import traceback
-from threading import Thread
+from threading import Thread, Lock, Condition
+from itertools import count
+from collections import namedtuple, OrderedDict
+import heapq
+import hashlib
+from queue import Queue, Empty, Full
 from math import exp
-from random import randint, choice, shuffle
-from datetime import datetime, date, timezone
-import json
+from random import randint, random
+from datetime import datetime, date, timezone, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
 import redis
 
 from configuration import (_APPLICATION, _SWVERSION, CDRTTL,
                            REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, SCAN_COUNT, REDIS_TIMEOUT,
-                           LOGDIR, HTTPCDR_ENDPOINTS, DISKCDR_ENABLE, CDRFNAME_INTERVAL, CDRFNAME_FMT)
+                           LOGDIR, HTTPCDR_ENDPOINTS, DISKCDR_ENABLE, CDRFNAME_INTERVAL, CDRFNAME_FMT,
+                           CDRWORKER_POOLSIZE, CDRWORKER_QUEUESIZE, CDRINGEST_BATCHSIZE, CDRQUEUE_RELIABLE, CDR_CONSUMERID, CDR_TRANSPORT,
+                           CDR_STREAM_GROUP, CDR_STREAM_CLAIMIDLE, CDRCLEAN_INTERVAL, CDRCLEAN_BATCHSIZE, HTTPCDR_BATCHSIZE, HTTPCDR_BATCHWAIT, HTTPCDR_BATCHFORMAT,
+                           HTTPCDR_POOLSIZE, HTTPCDR_CONNECT_TIMEOUT, HTTPCDR_READ_TIMEOUT, HTTPCDR_BREAKER_THRESHOLD, HTTPCDR_BREAKER_COOLDOWN, CDRSPOOL_REPLAYRATE, CDRSPOOL_SEGMENTSIZE,
+                           DISKCDR_FLUSHINTERVAL, DISKCDR_FLUSHSIZE, DISKCDR_COMPRESSION, CDR_SINKS,
+                           HTTPCDR_CONCURRENCY_MIN, HTTPCDR_CONCURRENCY_MAX, CDR_ENGINE, CDR_ASYNC_INFLIGHT, CDRDEDUP_WINDOW, CDRDEDUP_MAXSIZE, CDRBACKFILL_INTERVAL, CDR_DRAIN_TIMEOUT,
+                           CDRJOIN_WINDOW, CDRJOIN_MAXSIZE, CDRKPI_WINDOW, CDRKPI_INTERVAL)
 
-from utilities import logger
+from utilities import logger, CDRSUFFIXES, cdrcompressor
+import jsoncodec
+from cdrcodec import CDRPayload, negotiate
+
+MAXRETRY = 5
+# in reliable mode, uuid stay in this list from being taken until being cleaned
+CDRPROCESSING = f'cdr:queue:processing:{CDR_CONSUMERID}'
+# stream transport, cdr detail is carried inside the stream entry
+CDRSTREAM = 'cdr:stream'
+# retry schedule of failed delivery, uuid scored by due time
+CDRRETRY = f'cdr:retry:{CDR_CONSUMERID}'
+# undeliverable cdr waiting to be replayed
+CDRSPOOLDIR = f'{LOGDIR}/cdr/spool'
+# hash of raw cdr file name: byte offset already queued, per consumer as raw files are local to the node
+CDRBACKFILL = f'cdr:backfill:{CDR_CONSUMERID}'
+# zset of cdr uuid acknowledged by http endpoints, scored by acknowledged time
+CDRACKED = 'cdr:acked'
 
 REDIS_CONNECTION_POOL = redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD,
                                                      decode_responses=True, max_connections=10, timeout=REDIS_TIMEOUT)
@@ -162,6 +190,85 @@ SIP_DISPOSITIONS = {
 }
 
 
+# refined cdr fields in output order, with the detail key they are copied from, None for derived one
+CDRFIELDS = (
+    ('uuid', 'uuid'),
+    ('seshid', 'seshid'),
+    ('direction', 'direction'),
+    ('sipprofile', 'sipprofile'),
+    ('context', 'context'),
+    ('nodeid', 'nodeid'),
+    ('intconname', 'intconname'),
+    ('gateway', 'gateway_name'),
+    ('user_agent', 'user_agent'),
+    ('callid', 'callid'),
+    ('caller_name', 'caller_name'),
+    ('caller_number', 'caller_number'),
+    ('destination_number', 'destination_number'),
+    ('start_time', 'start_time'),
+    ('answer_time', 'answer_time'),
+    ('end_time', 'end_time'),
+    ('progress_time', 'progress_time'),
+    ('progress_media_time', 'progress_media_time'),
+    ('duration', None),
+    ('sip_network_ip', 'sip_network_ip'),
+    ('sip_network_port', 'sip_network_port'),
+    ('sip_local_network_addr', 'sip_local_network_addr'),
+    ('transport', None),
+    ('remote_media_ip', 'remote_media_ip'),
+    ('remote_media_port', 'remote_media_port'),
+    ('local_media_ip', 'local_media_ip'),
+    ('local_media_port', 'local_media_port'),
+    ('read_codec', 'read_codec'),
+    ('write_codec', 'write_codec'),
+    ('rtp_crypto', 'rtp_has_crypto'),
+    ('hangup_cause', None),
+    ('sip_resp_code', None),
+    ('disposition', None),
+    ('status', None),
+    # optional, only output when set
+    ('access_authid', 'access_authid'),
+    ('access_srcip', 'access_srcip'),
+    ('access_userid', 'access_userid'),
+)
+CDROPTIONALS = 3
+CDRKEYS = tuple(field for field, source in CDRFIELDS)
+CDRINDEXES = {field: index for index, field in enumerate(CDRKEYS)}
+CDRSOURCES = tuple(source for field, source in CDRFIELDS)
+CDRTIMES = tuple(CDRKEYS.index(field) for field in ('start_time', 'answer_time', 'end_time', 'progress_time', 'progress_media_time'))
+_DURATION, _TRANSPORT, _HANGUP_CAUSE, _SIP_RESP_CODE, _DISPOSITION, _STATUS = (CDRKEYS.index(field) for field in
+    ('duration', 'transport', 'hangup_cause', 'sip_resp_code', 'disposition', 'status'))
+# 'sip:487' -> 'CANCEL'
+SIP_STATUSES = {f'sip:{code}': status for code, status in SIP_DISPOSITIONS.items()}
+
+
+class CDRRecord(namedtuple('CDRRecord', CDRKEYS)):
+    """ refined cdr, a tuple in CDRFIELDS order """
+    __slots__ = ()
+
+    def asdict(self):
+        mandatory = len(CDRKEYS) - CDROPTIONALS
+        data = dict(zip(CDRKEYS[:mandatory], self[:mandatory]))
+        for field, value in zip(CDRKEYS[mandatory:], self[mandatory:]):
+            if value: data[field] = value
+        return data
+
+    def get(self, field, default=None):
+        # cdr field only, as a dict would; not the methods and attributes of the tuple
+        index = CDRINDEXES.get(field)
+        return default if index is None else self[index]
+
+    # log the same as the dict it replace
+    def __repr__(self):
+        return repr(self.asdict())
+
+
+class CDRUnrefined(dict):
+    """ cdr that failed the refinement, delivered as an empty document like before """
+    def asdict(self):
+        return {}
+
+
 def fmtime(epochtime):
     try:
         epochtime = float(epochtime)
@@ -171,12 +278,74 @@ def fmtime(epochtime):
         return None
 
 
+# epoch to iso format, the 'YYYY-MM-DDTHH:' part is cached per hour and 'MM:SS+00:00' part is precomputed
+_isohours = {}
+_ISOSECONDS = tuple(f'{minute:02d}:{second:02d}+00:00' for minute in range(60) for second in range(60))
+
+def epochiso(epochtime):
+    # fmtime for integer epoch string
+    if epochtime.__class__ is str:
+        try:
+            seconds = int(epochtime)
+            if seconds == 0: return None
+            hour, second = divmod(seconds, 3600)
+            prefix = _isohours.get(hour)
+            if prefix is None:
+                prefix = datetime.fromtimestamp(hour*3600, tz=timezone.utc).isoformat()[:14]
+                if len(_isohours) > 1024: _isohours.clear()
+                _isohours[hour] = prefix
+            return prefix + _ISOSECONDS[second]
+        except (ValueError, OverflowError, OSError):
+            pass
+    return fmtime(epochtime)
+
+
 def reebackoff(f, n):
     # random euler exponential backoff timer
     if n == 0: return randint(1, f)
     else: return randint(round(f * exp(1) ** (n-1)), round(f * exp(1) ** n))
 
 
+def cdrrefine(details):
+    # build CDRRecord from the cdr detail of callng, copied fields are taken by CDRSOURCES table
+    get = details.get
+    values = list(map(get, CDRSOURCES))
+    for index in CDRTIMES:
+        values[index] = epochiso(values[index])
+    duration = values[_DURATION] = get('duration', 0)
+    # transport
+    direction = values[2]
+    transport = 'udp'
+    if direction.lower() == 'inbound':
+        sip_via_protocol = get('sip_via_protocol')
+        if sip_via_protocol: transport = sip_via_protocol
+    else:
+        ruri_host, ruri_port, ruri_transport = parseruri(get('sip_req_uri'))
+        if ruri_transport: transport = ruri_transport
+    values[_TRANSPORT] = transport
+    # HANGUP CAUSE: 'NORMAL_CLEARING', 'ORIGINATOR_CANCEL' ...
+    hangup_cause = get('hangup_cause')
+    libre_hangup_cause = get('libre_hangup_cause')
+    if libre_hangup_cause:
+        hangup_cause = f'{hangup_cause}_BY_{libre_hangup_cause}'
+    values[_HANGUP_CAUSE] = hangup_cause
+    # HANGUP DEPOSITION: RECV_BYE, SEND_BYE ...
+    hangup_disposition = get('hangup_disposition')
+    values[_DISPOSITION] = f'LIBRESBC_{hangup_disposition.upper()}' if hangup_disposition else 'UNDEFINED'
+    # STATUS: ANSWER, BUSY DERIVED FROM SIP RESPONSES: 400, 503..
+    sip_resp_code = get('sip_hangup_cause') or get('bridge_sip_hangup_cause') or get('libre_sip_hangup_cause')
+    if not sip_resp_code:
+        if duration and duration.isdigit() and int(duration) > 0: sip_resp_code = 'sip:200'
+        elif get('sip_redirected_to'): sip_resp_code = 'sip:302'
+        else: sip_resp_code = 'sip:000'
+    values[_SIP_RESP_CODE] = sip_resp_code
+    status = SIP_STATUSES.get(sip_resp_code)
+    if status is None:
+        status = SIP_DISPOSITIONS.get(int(sip_resp_code.split(':')[1]), 'FAILURE')
+    values[_STATUS] = status
+    return CDRRecord._make(values)
+
+
 def parseruri(ruri):
     # sip:84987654321@libre.io:5060;transport=udp
     host, port, transport = None, None, None
@@ -206,214 +375,757 @@ def timefmtwrap():
 cdrtimestamp = timefmtwrap()
 
 
-class CDRHandler(Thread):
-    def __init__(self, uuid, details):
+def cdrwindow(current):
+    # name of the cdr file window that contain current datetime, and the epoch time the next window start
+    if CDRFNAME_INTERVAL:
+        start = current.replace(minute=CDRFNAME_INTERVAL*(current.minute//CDRFNAME_INTERVAL), second=0, microsecond=0)
+        boundary = min(start + timedelta(minutes=CDRFNAME_INTERVAL), start.replace(minute=0) + timedelta(hours=1))
+    else:
+        start = current.replace(hour=0, minute=0, second=0, microsecond=0)
+        boundary = start + timedelta(days=1)
+    return start.strftime(CDRFNAME_FMT), boundary.timestamp()
+
+
+def streamgroup(rdbconn):
+    try:
+        rdbconn.xgroup_create(CDRSTREAM, CDR_STREAM_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        # BUSYGROUP: group is already existed
+        if 'BUSYGROUP' not in str(e): raise
+
+
+def streamentries(reply):
+    # [(entryid, {uuid, detail}), ..] -> [(uuid, detail, entryid), ..], entry deleted before being claimed have no field
+    return [(fields.get('uuid'), fields.get('detail'), entryid) for entryid, fields in reply if fields]
+
+
+def cdrrecover(rdbconn):
+    # requeue the uuid left in processing list by a previous run, at the head so they are processed first
+    recovered = 0
+    try:
+        while rdbconn.lmove(CDRPROCESSING, 'cdr:queue:new', 'RIGHT', 'LEFT'):
+            recovered += 1
+        logger.info(f"module=liberator, space=cdr, action=cdrrecover, processing={CDRPROCESSING}, recovered={recovered}")
+    except Exception as e:
+        logger.error(f"module=liberator, space=cdr, action=cdrrecover, processing={CDRPROCESSING}, recovered={recovered}, exception={e}, tracings={traceback.format_exc()}")
+    return recovered
+
+
+def cdrtake(rdbconn, batchsize):
+    # block for the first uuid of cdr:queue:new, then take the rest of batch without waiting
+    if CDRQUEUE_RELIABLE:
+        uuid = rdbconn.blmove('cdr:queue:new', CDRPROCESSING, REDIS_TIMEOUT, 'LEFT', 'RIGHT')
+        if not uuid: return []
+        uuids = [uuid]
+        if batchsize > 1:
+            pipe = rdbconn.pipeline(transaction=False)
+            for _ in range(batchsize-1):
+                pipe.lmove('cdr:queue:new', CDRPROCESSING, 'LEFT', 'RIGHT')
+            uuids += [uuid for uuid in pipe.execute() if uuid]
+    else:
+        reply = rdbconn.blpop('cdr:queue:new', REDIS_TIMEOUT)
+        if not reply: return []
+        uuids = [reply[1]]
+        if batchsize > 1:
+            pipe = rdbconn.pipeline(transaction=True)
+            pipe.lrange('cdr:queue:new', 0, batchsize-2)
+            pipe.ltrim('cdr:queue:new', batchsize-1, -1)
+            uuids += pipe.execute()[0]
+    return uuids
+
+
+def cdrsweep(rdbconn, cutoff_time, batchsize=500):
+    # in-progress uuid older than cutoff: requeue the ones whose detail still exist, drop the lost ones
+    recovered = lost = 0
+    while True:
+        uuids = rdbconn.zrangebyscore('cdr:inprogress', '-inf', cutoff_time, start=0, num=batchsize)
+        if not uuids: break
+        pipe = rdbconn.pipeline(transaction=False)
+        for uuid in uuids: pipe.exists(f'cdr:detail:{uuid}')
+        existences = pipe.execute()
+        # the sweeper that remove an uuid own it, it may have been delivered or swept by another consumer meanwhile
+        pipe = rdbconn.pipeline(transaction=False)
+        for uuid in uuids: pipe.zrem('cdr:inprogress', uuid)
+        owned = pipe.execute()
+        pipe = rdbconn.pipeline(transaction=True)
+        for uuid, existence, removed in zip(uuids, existences, owned):
+            if not removed: continue
+            if CDRQUEUE_RELIABLE: pipe.lrem(CDRPROCESSING, 1, uuid)
+            if existence:
+                pipe.lpush('cdr:queue:new', uuid)
+                recovered += 1
+            else:
+                logger.warning(f"module=liberator, space=cdr, action=cdrsweep, state=detail_expired, uuid={uuid}, note=CDR_LOST")
+                lost += 1
+        pipe.execute()
+        if len(uuids) < batchsize: break
+    return recovered, lost
+
+
+def cdrrequeue(rdbconn, entries):
+    # hand list transport cdr back to the head of queue in their order, stream entries stay pending for this consumer;
+    # cdr already acknowledged by endpoint are only cleaned
+    acked = [(uuid, entryid) for uuid, entryid in entries if cdrdedup.seen(uuid)]
+    uuids = [uuid for uuid, entryid in entries if not entryid and (uuid, entryid) not in acked]
+    if not uuids and not acked: return 0
+    pipe = rdbconn.pipeline(transaction=True)
+    for uuid, entryid in acked:
+        if entryid:
+            pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, entryid)
+            pipe.xdel(CDRSTREAM, entryid)
+        else:
+            pipe.delete(f'cdr:detail:{uuid}')
+    listuuids = uuids + [uuid for uuid, entryid in acked if not entryid]
+    if listuuids:
+        pipe.zrem('cdr:inprogress', *listuuids)
+        pipe.zrem(CDRRETRY, *listuuids)
+        if CDRQUEUE_RELIABLE:
+            for uuid in listuuids: pipe.lrem(CDRPROCESSING, 1, uuid)
+    if uuids:
+        pipe.lpush('cdr:queue:new', *reversed(uuids))
+    pipe.execute()
+    return len(uuids)
+
+
+class CDRDrain:
+    """ shutdown phase: retry backoff are skipped, a cdr that can not be delivered at once is spooled """
+    def __init__(self):
+        self.active = False
+        self.lock = Lock()
+        # handler created and not yet released
+        self.inhand = 0
+        self.completed = 0
+        self.spooled = 0
+        self.filed = 0
+
+    def track(self, number):
+        with self.lock:
+            self.inhand += number
+
+    def count(self, cdrsaved, spooled):
+        if not self.active: return
+        with self.lock:
+            if cdrsaved: self.completed += 1
+            elif spooled: self.spooled += 1
+            else: self.filed += 1
+
+
+cdrdrain = CDRDrain()
+
+
+# shared keep-alive session per endpoint
+_httpsessions = {}
+_httpsessionlock = Lock()
+
+def httpsession(endpoint):
+    session = _httpsessions.get(endpoint)
+    if session is None:
+        with _httpsessionlock:
+            session = _httpsessions.get(endpoint)
+            if session is None:
+                poolsize = HTTPCDR_POOLSIZE or CDRWORKER_POOLSIZE
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolsize, pool_block=True, max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _httpsessions[endpoint] = session
+    return session
+
+
+def httpstats():
+    # number of requests and new connections per endpoint, reuse is the ratio of request sent on an already open connection
+    stats = {}
+    for endpoint, session in list(_httpsessions.items()):
+        try:
+            poolmanager = session.get_adapter(endpoint).poolmanager
+            pools = [poolmanager.pools[key] for key in poolmanager.pools.keys()]
+            requested = sum(pool.num_requests for pool in pools)
+            connected = sum(pool.num_connections for pool in pools)
+            reuse = round(1 - connected/requested, 4) if requested else None
+            stats[endpoint] = {'requests': requested, 'connections': connected, 'reuse': reuse}
+        except Exception as e:
+            logger.warning(f"module=liberator, space=cdr, action=httpstats, endpoint={endpoint}, exception={e}")
+    return stats
+
+
+class CDREndpoint:
+    """ health of an http cdr endpoint: ewma latency and error rate, guarded by a circuit breaker and a concurrency limit """
+    def __init__(self, url):
+        self.url = url
+        self.latency = None
+        self.errorrate = 0.0
+        self.failures = 0
+        self.inflight = 0
+        # closed: in use, open: skipped until cooldown, halfopen: a single probe is in flight
+        self.state = 'closed'
+        self.opened_at = 0
+        # aimd: limit double per round trip up to threshold (slow start) then grow by one, it is cut on overload
+        self.limit = HTTPCDR_CONCURRENCY_MIN
+        self.threshold = CONCURRENCY_MAX
+        self.baseline = None
+        self.decreased_at = 0
+        # json until the endpoint answer with Accept header of a compact encoding
+        self.encoding = 'json'
+
+    def score(self):
+        # expected delay weighted by load and error rate, unmeasured endpoint go first
+        return (self.latency or 0) * (self.inflight + 1) / max(1 - self.errorrate, 0.05)
+
+    def capacity(self):
+        if self.state == 'halfopen': return 1
+        return int(self.limit)
+
+    def decrease(self, factor):
+        # once per round trip, the responses of requests sent before the cut do not cut it again
+        current_time = time.time()
+        if current_time - self.decreased_at < (self.latency or 0): return
+        self.limit = max(HTTPCDR_CONCURRENCY_MIN, self.limit * factor)
+        self.threshold = max(HTTPCDR_CONCURRENCY_MIN, self.limit)
+        self.decreased_at = current_time
+
+    def increase(self):
+        if self.limit < self.threshold: self.limit += 1
+        else: self.limit += 1/self.limit
+        self.limit = min(self.limit, CONCURRENCY_MAX)
+
+
+EWMA_ALPHA = 0.2
+BASELINE_ALPHA = 0.01
+# short-term latency above LATENCY_TOLERANCE times the long-term one means the collector is queueing
+LATENCY_TOLERANCE = 2
+CONCURRENCY_MAX = HTTPCDR_CONCURRENCY_MAX or HTTPCDR_POOLSIZE or (CDR_ASYNC_INFLIGHT if CDR_ENGINE == 'asyncio' else CDRWORKER_POOLSIZE)
+_endpoints = {url: CDREndpoint(url) for url in (HTTPCDR_ENDPOINTS or [])}
+_endpointlock = Condition()
+# wakeup of the waiters that can not block on the lock, such as an event loop
+_endpointwatchers = []
+
+def endpointorder():
+    # endpoints to try in order, best one first; an open endpoint past its cooldown is given to one caller as probe
+    with _endpointlock:
+        current_time = time.time()
+        probes = []
+        for endpoint in _endpoints.values():
+            if endpoint.state == 'open' and current_time - endpoint.opened_at >= HTTPCDR_BREAKER_COOLDOWN:
+                endpoint.state = 'halfopen'
+                probes.append(endpoint)
+        closed = sorted((endpoint for endpoint in _endpoints.values() if endpoint.state == 'closed'), key=lambda endpoint: (endpoint.score(), random()))
+        return probes + closed
+
+
+def endpointacquire(candidates, timeout):
+    # take a slot on the first candidate under its concurrency limit, waiting up to timeout second for one
+    deadline = time.time() + timeout
+    with _endpointlock:
+        while True:
+            for endpoint in candidates:
+                if endpoint.inflight < endpoint.capacity():
+                    endpoint.inflight += 1
+                    return endpoint
+            remaining = deadline - time.time()
+            if remaining <= 0: return None
+            _endpointlock.wait(remaining)
+
+
+def endpointwatch(wakeup):
+    # wakeup is called, without argument and holding the lock, whenever a slot may have been released
+    with _endpointlock:
+        _endpointwatchers.append(wakeup)
+
+
+def _endpointnotify():
+    _endpointlock.notify_all()
+    for wakeup in _endpointwatchers:
+        wakeup()
+
+
+def endpointskip(candidates):
+    # probe that was not used go back to open
+    with _endpointlock:
+        for endpoint in candidates:
+            if endpoint.state == 'halfopen' and not endpoint.inflight: endpoint.state = 'open'
+
+
+def endpointreport(endpoint, outcome, delay):
+    # outcome: success, overload (timeout, 5xx, 429), failure, or neutral that only release the slot (415 renegotiated)
+    with _endpointlock:
+        endpoint.inflight -= 1
+        if outcome == 'neutral':
+            _endpointnotify()
+            return
+        success = outcome == 'success'
+        endpoint.errorrate = (1-EWMA_ALPHA) * endpoint.errorrate + EWMA_ALPHA * (0 if success else 1)
+        if success:
+            endpoint.latency = delay if endpoint.latency is None else (1-EWMA_ALPHA) * endpoint.latency + EWMA_ALPHA * delay
+            # long-term latency, a queue building at the collector raise the short-term one well above it
+            endpoint.baseline = delay if endpoint.baseline is None else (1-BASELINE_ALPHA) * endpoint.baseline + BASELINE_ALPHA * delay
+            endpoint.failures = 0
+            if endpoint.state != 'closed':
+                # recovered, slow start back to the limit before outage
+                endpoint.state = 'closed'
+                endpoint.limit = HTTPCDR_CONCURRENCY_MIN
+                logger.info(f"module=liberator, space=cdr, action=circuitbreaker, endpoint={endpoint.url}, state=closed")
+            if endpoint.latency <= endpoint.baseline * LATENCY_TOLERANCE:
+                endpoint.increase()
+            else:
+                endpoint.decrease(0.9)
+        else:
+            if outcome == 'overload':
+                endpoint.decrease(0.5)
+            endpoint.failures += 1
+            if endpoint.state == 'halfopen' or (endpoint.state == 'closed' and endpoint.failures >= HTTPCDR_BREAKER_THRESHOLD):
+                endpoint.state = 'open'
+                endpoint.opened_at = time.time()
+                logger.warning(f"module=liberator, space=cdr, action=circuitbreaker, endpoint={endpoint.url}, state=open, failures={endpoint.failures}, errorrate={round(endpoint.errorrate, 3)}")
+        _endpointnotify()
+
+
+def endpointstats():
+    with _endpointlock:
+        return {endpoint.url: {'state': endpoint.state, 'latency': endpoint.latency and round(endpoint.latency, 4),
+                               'errorrate': round(endpoint.errorrate, 4), 'inflight': endpoint.inflight, 'limit': round(endpoint.limit, 2),
+                               'encoding': endpoint.encoding}
+                for endpoint in _endpoints.values()}
+
+
+class CDRDedup(Thread):
+    """ time-windowed set of cdr uuid acknowledged by http endpoints, mirrored to redis across restart """
+    def __init__(self, window, maxsize, interval=1, triminterval=60):
         self.stop = False
-        self.uuid = uuid
-        self.details = details
+        self.window = window
+        self.maxsize = maxsize
+        self.interval = interval
+        self.triminterval = triminterval
+        # uuid: acknowledged time, oldest first
+        self.acked = OrderedDict()
+        # acknowledged uuid not yet mirrored to redis
+        self.unsynced = {}
+        self.trimmed = time.time()
+        self.lock = Lock()
         Thread.__init__(self)
+        self.setName('CDRDedup')
+
+    def seen(self, uuid):
+        if not self.window: return False
+        with self.lock:
+            acktime = self.acked.get(uuid)
+            return acktime is not None and time.time() - acktime < self.window
+
+    def expire(self, current_time):
+        while self.acked:
+            uuid, acktime = next(iter(self.acked.items()))
+            if len(self.acked) <= self.maxsize and current_time - acktime < self.window: break
+            self.acked.popitem(last=False)
+
+    def add(self, uuids):
+        if not self.window or not uuids: return
+        current_time = time.time()
+        with self.lock:
+            for uuid in uuids:
+                self.acked[uuid] = current_time
+                self.acked.move_to_end(uuid)
+                self.unsynced[uuid] = current_time
+            self.expire(current_time)
+
+    def flush(self):
+        # acknowledgements of the last interval in a single call, the sorted set is trimmed once in a while
+        with self.lock:
+            unsynced, self.unsynced = self.unsynced, {}
+        current_time = time.time()
+        trimming = current_time - self.trimmed >= self.triminterval
+        if not unsynced and not trimming: return
+        try:
+            pipe = rdbconn.pipeline(transaction=False)
+            if unsynced:
+                pipe.zadd(CDRACKED, unsynced)
+            if trimming:
+                pipe.zremrangebyscore(CDRACKED, '-inf', current_time - self.window)
+                pipe.zremrangebyrank(CDRACKED, 0, -self.maxsize-1)
+            pipe.execute()
+            if trimming: self.trimmed = current_time
+        except Exception as e:
+            logger.warning(f"module=liberator, space=cdr, class=CDRDedup, action=flush, size={len(unsynced)}, exception={e}")
+            # mirrored on next flush, unless acknowledged again meanwhile
+            with self.lock:
+                for uuid, acktime in unsynced.items():
+                    self.unsynced.setdefault(uuid, acktime)
+
+    def load(self, rdbconn):
+        # acknowledgements made before restart, recovered or replayed cdr among them are not sent again
+        if not self.window: return
+        current_time = time.time()
+        acked = rdbconn.zrangebyscore(CDRACKED, current_time - self.window, '+inf', withscores=True)
+        with self.lock:
+            merged = dict(acked)
+            merged.update(self.acked)
+            self.acked = OrderedDict(sorted(merged.items(), key=lambda item: item[1]))
+            self.expire(current_time)
+        logger.info(f"module=liberator, space=cdr, class=CDRDedup, action=load, loaded={len(acked)}, size={len(self.acked)}")
 
     def run(self):
-        MAXRETRY = 5
+        logger.info(f"module=liberator, space=cdr, action=start_dedup_thread, window={self.window}, maxsize={self.maxsize}, interval={self.interval}")
+        while not self.stop:
+            time.sleep(self.interval)
+            self.flush()
+        self.flush()
+
+
+cdrdedup = CDRDedup(CDRDEDUP_WINDOW, CDRDEDUP_MAXSIZE)
+
+
+# refined status of call the network delivered to the callee, whatever the callee did (NER)
+KPI_EFFECTIVES = ('ANSWERED', 'BUSY', 'NOANSWER', 'CANCEL')
+
+class CDRKPI(Thread):
+    """ per minute kpi counters of interconnection and gateway, added up in redis hashes that expire after window minutes """
+    def __init__(self, window, interval):
+        self.stop = False
+        self.window = window
+        self.interval = interval
+        self.lock = Lock()
+        # (kind, name, minute): counters not yet added to redis
+        self.buckets = {}
+        Thread.__init__(self)
+        self.setName('CDRKPI')
+
+    def add(self, details, cdrdata):
         try:
-            # parse and refine cdr
-            self.refine()
-            logger.info(f"module=liberator, space=cdr, action=cdrnotifier, uuid={self.uuid}, data={self.cdrdata}")
-            # save the cdr to destination
-            cdrsaved = True; waiting = 5; attempt = 0
-            while attempt < MAXRETRY and not self.stop:
-                # primary task to save cdr
-                if HTTPCDR_ENDPOINTS:
-                    cdrsaved = self.httpsave()
-
-                # data stored guarantee process
-                attempt += 1
-                if cdrsaved:
-                    if attempt > MAXRETRY-2:
-                        logger.info(f"module=liberator, space=cdr, action=savehandler, state=clear, uuid={self.uuid}, attempted={attempt}")
-                    break
-                else:
-                    backoff = reebackoff(waiting, attempt)
-                    if attempt >= MAXRETRY-2:
-                        logger.warning(f"module=liberator, space=cdr, action=savehandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
-                    time.sleep(backoff)
+            minute = int(float(details.get('end_time') or 0))//60
+            current = int(time.time())//60
+            # too late for the window, or clock of callng gone wrong
+            if not minute or minute > current + 1: minute = current
+            if minute <= current - self.window: return
+            counters = {'attempts': 1, f'cause:{cdrdata.hangup_cause}': 1}
+            if cdrdata.status == 'ANSWERED':
+                counters['answered'] = 1
+                counters['billsec'] = int(cdrdata.duration or 0)
+            if cdrdata.status in KPI_EFFECTIVES:
+                counters['effective'] = 1
+            # post dial delay in millisecond
+            start_time, progress_time = float(details.get('start_time') or 0), float(details.get('progress_time') or 0)
+            if start_time and progress_time >= start_time:
+                counters['pddsum'] = int((progress_time - start_time)*1000)
+                counters['pddcount'] = 1
+            names = [('intcon', cdrdata.intconname)]
+            if cdrdata.direction == 'outbound': names.append(('gateway', cdrdata.gateway))
+            with self.lock:
+                for kind, name in names:
+                    if not name: continue
+                    bucket = self.buckets.setdefault((kind, name, minute), {})
+                    for field, value in counters.items():
+                        bucket[field] = bucket.get(field, 0) + value
+        except Exception as e:
+            logger.warning(f"module=liberator, space=cdr, class=CDRKPI, action=add, uuid={cdrdata.uuid}, exception={e}")
 
-            # save cdr to local file
-            if (not cdrsaved) or DISKCDR_ENABLE:
-                self.filesave()
-
-            # post process after saving the cdr, clean cdr on redis
-            rcleaned = False; waiting = 5; attempt = 0
-            while attempt < MAXRETRY and not self.stop:
-                rcleaned = self.rclean()
-                attempt += 1
-                if rcleaned:
-                    if attempt > MAXRETRY-2:
-                        logger.info(f"module=liberator, space=cdr, action=rdbhandler, state=clear, uuid={self.uuid}, attempted={attempt}")
-                    break
-                else:
-                    backoff = reebackoff(waiting, attempt)
-                    if attempt >= MAXRETRY-2:
-                        logger.warning(f"module=liberator, space=cdr, action=rdbhandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
-                    time.sleep(backoff)
+    def flush(self):
+        with self.lock:
+            buckets, self.buckets = self.buckets, {}
+        if not buckets: return
+        current = int(time.time())//60
+        try:
+            pipe = rdbconn.pipeline(transaction=False)
+            for (kind, name, minute), bucket in buckets.items():
+                key = f'kpi:{kind}:{name}:{minute}'
+                for field, value in bucket.items():
+                    pipe.hincrby(key, field, value)
+                pipe.expireat(key, (minute + self.window + 1)*60)
+                # names with kpi in window, by their last minute
+                pipe.zadd(f'kpi:{kind}', {name: minute}, gt=True)
+            for kind in ('intcon', 'gateway'):
+                pipe.zremrangebyscore(f'kpi:{kind}', '-inf', current - self.window)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"module=liberator, space=cdr, class=CDRKPI, action=flush, size={len(buckets)}, exception={e}")
+            # counted again on next flush, some may have been added already
+            with self.lock:
+                for identity, bucket in buckets.items():
+                    merged = self.buckets.setdefault(identity, {})
+                    for field, value in bucket.items():
+                        merged[field] = merged.get(field, 0) + value
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_kpi_thread, window={self.window}, interval={self.interval}")
+        while not self.stop:
+            until = time.time() + self.interval
+            while not self.stop and time.time() < until:
+                time.sleep(min(1, until - time.time()))
+            self.flush()
+
+
+cdrkpi = CDRKPI(CDRKPI_WINDOW, CDRKPI_INTERVAL)
+
+
+def idempotencykey(uuids):
+    # a single cdr is keyed by its uuid, a batch by the digest of its uuids
+    if len(uuids) == 1: return uuids[0]
+    return hashlib.sha1(','.join(uuids).encode()).hexdigest()
+
+
+def endpointnegotiate(endpoint, status, accept, encoding):
+    # endpoint opt into a compact encoding by the Accept header of its responses, return True to post again in the new one
+    previous = endpoint.encoding
+    if accept:
+        endpoint.encoding = negotiate(accept)
+    elif status == 415:
+        endpoint.encoding = 'json'
+    if endpoint.encoding != previous:
+        logger.info(f"module=liberator, space=cdr, action=negotiate, endpoint={endpoint.url}, status={status}, encoding={endpoint.encoding}, previous={previous}")
+    return status == 415 and endpoint.encoding != encoding
+
+
+def httppost(content, idempotency=None):
+    # post cdr payload to the first endpoint that accept it, in the encoding of that endpoint, return its response or None if all failed
+    signature = {'X-Signature': f'{_APPLICATION} {_SWVERSION}'}
+    # collector drop a request it already accepted with the same key, eg: retry after a read timeout
+    if idempotency: signature['Idempotency-Key'] = idempotency
+    candidates = endpointorder()
+    # endpoint that changed encoding on a 415, it is posted again once
+    renegotiated = set()
+    status = 0; attempt = 0; accepted = None
+    while candidates and accepted is None:
+        # wait for a free slot while every endpoint is at its limit, that is the backpressure to workers
+        endpoint = endpointacquire(candidates, HTTPCDR_READ_TIMEOUT)
+        if endpoint is None: break
+        candidates.remove(endpoint)
+        attempt += 1; start = time.time(); outcome = 'failure'
+        try:
+            encoding = endpoint.encoding
+            payload, headers = content.encode(encoding)
+            response = httpsession(endpoint.url).post(endpoint.url, headers={**headers, **signature}, data=payload, timeout=(HTTPCDR_CONNECT_TIMEOUT, HTTPCDR_READ_TIMEOUT))
+            status = response.status_code
+            if status==200:
+                outcome = 'success'
+                accepted = response, endpoint.url, attempt, round(time.time()-start, 3)
+            elif status >= 500 or status == 429:
+                outcome = 'overload'
+            if endpointnegotiate(endpoint, status, response.headers.get('Accept'), encoding) and endpoint.url not in renegotiated:
+                # tried again at once in the encoding it take, the 415 tell nothing of its health
+                outcome = 'neutral'
+                renegotiated.add(endpoint.url)
+                candidates.insert(0, endpoint)
+        except requests.exceptions.Timeout as e:
+            outcome = 'overload'
+            logger.warning(f"module=liberator, space=cdr, action=httppost, endpoint={endpoint.url}, status={status}, attempt={attempt}, exception={e}")
+        except Exception as e: # once exception occurred, log the error then retry
+            logger.warning(f"module=liberator, space=cdr, action=httppost, endpoint={endpoint.url}, status={status}, attempt={attempt}, exception={e}, tracings={traceback.format_exc()}")
+        finally:
+            endpointreport(endpoint, outcome, time.time()-start)
+    endpointskip(candidates)
+    if accepted is not None:
+        return accepted
+    return None, None, attempt, None
 
+
+def httpbatch(pending, batchformat, attempt):
+    # post cdr of handlers as a single request, return the handlers which are not yet accepted by collector
+    pending = [handler for handler in pending if not cdrdedup.seen(handler.uuid)]
+    if not pending: return pending
+    content = CDRPayload([handler.cdrdata for handler in pending], batchformat)
+    response, endpoint, _attempt, delay = httppost(content, idempotencykey([handler.uuid for handler in pending]))
+    if response is None:
+        logger.warning(f"module=liberator, space=cdr, action=httpbatch, state=failed, size={len(pending)}, attempt={attempt}")
+        return pending
+    # collector may partly accept the batch by answer {"rejected": [uuid, ...]}
+    rejected = set()
+    try:
+        if response.headers.get('Content-Type', '').startswith('application/json'):
+            rejected = set(response.json().get('rejected') or [])
+    except Exception: pass
+    failures = [handler for handler in pending if handler.uuid in rejected]
+    cdrdedup.add([handler.uuid for handler in pending if handler.uuid not in rejected])
+    for handler in failures:
+        logger.warning(f"module=liberator, space=cdr, action=httpbatch, state=rejected, uuid={handler.uuid}, endpoint={endpoint}, attempt={attempt}")
+    logger.info(f"module=liberator, space=cdr, action=httpbatch, endpoint={endpoint}, status={response.status_code}, size={len(pending)}, rejected={len(failures)}, attempt={attempt}, delay={delay}")
+    return failures
+
+
+class CDRHandler:
+    def __init__(self, uuid, details, batcher=None, entryid=None, cleaner=None, retrier=None, spool=None, filewriter=None, sinks=None, joiner=None):
+        self.stop = False
+        self.uuid = uuid
+        self.details = details
+        self.batcher = batcher
+        # stream entry id, with stream transport only
+        self.entryid = entryid
+        self.cleaner = cleaner
+        self.retrier = retrier
+        self.spool = spool
+        self.filewriter = filewriter
+        self.sinks = sinks
+        self.joiner = joiner
+        self.cdrdata = None
+        self.attempt = 0
+        # fan-out: mandatory sinks not yet acknowledged and the ones that gave up
+        self.waiting = 0
+        self.failed = None
+        self.acklock = None
+
+    def run(self):
+        try:
+            # parse and refine cdr, once for all the delivery attempts
+            if self.cdrdata is None:
+                self.refine()
+                logger.info(f"module=liberator, space=cdr, action=cdrnotifier, uuid={self.uuid}, data={self.cdrdata}")
+            # save the cdr to destination, with batching mode the batcher finalize it once batch is delivered
+            if self.sinks:
+                self.fanout()
+            elif HTTPCDR_ENDPOINTS and self.batcher:
+                self.batcher.submit(self)
+            elif HTTPCDR_ENDPOINTS and self.retrier:
+                self.deliver()
+            else:
+                self.finalize(self.save())
         except Exception as e:
             logger.error(f"module=liberator, space=cdr, class=CDRHandler, action=run, uuid={self.uuid}, exception={e}, tracings={traceback.format_exc()}")
             time.sleep(5)
         finally: pass
 
-    def refine(self):
-        try:
-            uuid = self.details.get('uuid')
-            seshid = self.details.get('seshid')
-            direction = self.details.get('direction')
-            sipprofile = self.details.get('sipprofile')
-            context = self.details.get('context')
-            nodeid = self.details.get('nodeid')
-            intconname = self.details.get('intconname')
-            gateway = self.details.get('gateway_name')
-            user_agent = self.details.get('user_agent')
-            callid = self.details.get('callid')
-            caller_name = self.details.get('caller_name')
-            caller_number = self.details.get('caller_number')
-            destination_number = self.details.get('destination_number')
-            # datatime
-            start_time = fmtime(self.details.get('start_time'))
-            answer_time  = fmtime(self.details.get('answer_time'))
-            end_time = fmtime(self.details.get('end_time'))
-            progress_time = fmtime(self.details.get('progress_time'))
-            progress_media_time = fmtime(self.details.get('progress_media_time'))
-            duration = self.details.get('duration', 0)
-            # sip address
-            sip_network_ip = self.details.get('sip_network_ip')
-            sip_network_port = self.details.get('sip_network_port')
-            sip_local_network_addr = self.details.get('sip_local_network_addr')
-            sip_req_uri = self.details.get('sip_req_uri')
-            # access
-            access_authid = self.details.get('access_authid')
-            access_srcip = self.details.get('access_srcip')
-            access_userid = self.details.get('access_userid')
-            # transport
-            transport = 'udp'
-            if direction.lower() == 'inbound':
-                sip_via_protocol = self.details.get('sip_via_protocol')
-                if sip_via_protocol: transport = sip_via_protocol
+    def save(self):
+        cdrsaved = True; waiting = 5; attempt = 0
+        while attempt < MAXRETRY and not self.stop:
+            # primary task to save cdr
+            if HTTPCDR_ENDPOINTS:
+                cdrsaved = self.httpsave()
+
+            # data stored guarantee process
+            attempt += 1
+            if cdrsaved:
+                if attempt > MAXRETRY-2:
+                    logger.info(f"module=liberator, space=cdr, action=savehandler, state=clear, uuid={self.uuid}, attempted={attempt}")
+                break
             else:
-                ruri_host, ruri_port, ruri_transport = parseruri(sip_req_uri)
-                if ruri_transport: transport = ruri_transport
-            # media
-            remote_media_ip = self.details.get('remote_media_ip')
-            remote_media_port = self.details.get('remote_media_port')
-            local_media_ip = self.details.get('local_media_ip')
-            local_media_port = self.details.get('local_media_port')
-            advertised_media_ip = self.details.get('advertised_media_ip', '')
-            read_codec = self.details.get('read_codec')
-            write_codec = self.details.get('write_codec')
-            rtp_crypto = self.details.get('rtp_has_crypto')
-            # HANGUP CAUSE: 'NORMAL_CLEARING', 'ORIGINATOR_CANCEL' ...
-            hangup_cause = self.details.get('hangup_cause')
-            libre_hangup_cause = self.details.get('libre_hangup_cause')
-            if libre_hangup_cause:
-                hangup_cause = f'{hangup_cause}_BY_{libre_hangup_cause}'
-            # HANGUP DEPOSITION: RECV_BYE, SEND_BYE ...
-            hangup_disposition = self.details.get('hangup_disposition')
-            disposition = f'LIBRESBC_{hangup_disposition.upper()}' if hangup_disposition else 'UNDEFINED'
-            # STATUS: ANSWER, BUSY DERIVED FROM SIP RESPONSES: 400, 503..
-            sip_hangup_cause = self.details.get('sip_hangup_cause')
-            bridge_sip_hangup_cause = self.details.get('bridge_sip_hangup_cause')
-            libre_sip_hangup_cause = self.details.get('libre_sip_hangup_cause')
-            sip_redirected_to = self.details.get('sip_redirected_to')
-            if sip_hangup_cause: sip_resp_code = sip_hangup_cause
-            elif bridge_sip_hangup_cause: sip_resp_code = bridge_sip_hangup_cause
-            elif libre_sip_hangup_cause: sip_resp_code = libre_sip_hangup_cause
+                if cdrdrain.active: break
+                backoff = reebackoff(waiting, attempt)
+                if attempt >= MAXRETRY-2:
+                    logger.warning(f"module=liberator, space=cdr, action=savehandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
+                time.sleep(backoff)
+        return cdrsaved
+
+    def deliver(self):
+        # single attempt per run, a failed cdr wait in the retrier instead of holding the worker
+        cdrsaved = self.httpsave()
+        self.attempt += 1
+        if cdrsaved:
+            if self.attempt > MAXRETRY-2:
+                logger.info(f"module=liberator, space=cdr, action=savehandler, state=clear, uuid={self.uuid}, attempted={self.attempt}")
+            self.finalize(True)
+        elif self.attempt >= MAXRETRY or cdrdrain.active:
+            self.finalize(False)
+        else:
+            backoff = reebackoff(5, self.attempt)
+            if self.attempt >= MAXRETRY-2:
+                logger.warning(f"module=liberator, space=cdr, action=savehandler, state=stuck, uuid={self.uuid}, attempted={self.attempt}, backoff={backoff}")
+            self.retrier.schedule([self], backoff)
+
+    def fanout(self):
+        # every sink take the cdr on its own queue, it is finalized once all mandatory sinks acknowledged
+        mandatory = len([sink for sink in self.sinks if sink.mandatory])
+        self.waiting = mandatory
+        self.failed = []
+        self.acklock = Lock()
+        # with the join, the sinks get the cdr once the other legs of the call arrived
+        if self.joiner:
+            self.joiner.submit(self)
+        else:
+            for sink in self.sinks:
+                sink.submit(self)
+        # the sinks may already acknowledged and finalized it, only the count taken before submitting tell
+        if not mandatory:
+            self.finalize(True)
+
+    def legs(self):
+        return [self]
+
+    def acknowledge(self, sink, success):
+        if not sink.mandatory: return
+        with self.acklock:
+            if not success: self.failed.append(sink.name)
+            self.waiting -= 1
+            if self.waiting: return
+        if self.failed:
+            logger.warning(f"module=liberator, space=cdr, action=acknowledge, uuid={self.uuid}, failed={self.failed}")
+        self.finalize(not self.failed)
+
+    def finalize(self, cdrsaved):
+        # save cdr to local file, with file writer the rest is done once the file is committed
+        if (not cdrsaved) or (DISKCDR_ENABLE and not self.sinks):
+            if self.filewriter:
+                self.filewriter.submit(self, cdrsaved)
+                return
+            self.filesave()
+        self.release(cdrsaved)
+
+    def spoolable(self, cdrsaved):
+        # keep undeliverable cdr in the spool, so it is sent again once endpoints recover
+        return bool(not cdrsaved and HTTPCDR_ENDPOINTS and self.spool and self.cdrdata and (self.failed is None or 'http' in self.failed))
+
+    def release(self, cdrsaved, spooled=None):
+        # the file writer give spooled, it spool the cdr of a flush together
+        if spooled is None:
+            spooled = self.spoolable(cdrsaved)
+            if spooled: self.spool.append([self.cdrdata])
+        cdrdrain.count(cdrsaved, spooled)
+        cdrdrain.track(-1)
+        # counted once the cdr is done with, not on refine that a recovered or handed back cdr go through again
+        if CDRKPI_WINDOW and isinstance(self.cdrdata, CDRRecord): cdrkpi.add(self.details, self.cdrdata)
+
+        # post process after saving the cdr, clean cdr on redis
+        if self.cleaner:
+            self.cleaner.submit(self.uuid, self.entryid)
+            return
+        rcleaned = False; waiting = 5; attempt = 0
+        while attempt < MAXRETRY and not self.stop:
+            rcleaned = self.rclean()
+            attempt += 1
+            if rcleaned:
+                if attempt > MAXRETRY-2:
+                    logger.info(f"module=liberator, space=cdr, action=rdbhandler, state=clear, uuid={self.uuid}, attempted={attempt}")
+                break
             else:
-                if duration and duration.isdigit() and int(duration) > 0: sip_resp_code = 'sip:200'
-                elif sip_redirected_to: sip_resp_code = 'sip:302'
-                else: sip_resp_code = 'sip:000'
-            status = SIP_DISPOSITIONS.get(int(sip_resp_code.split(':')[1]), 'FAILURE')
-
-            cdrdata = {
-                'uuid': uuid,
-                'seshid': seshid,
-                'direction': direction,
-                'sipprofile': sipprofile,
-                'context': context,
-                'nodeid': nodeid,
-                'intconname': intconname,
-                'gateway': gateway,
-                'user_agent': user_agent,
-                'callid': callid,
-                'caller_name': caller_name,
-                'caller_number': caller_number,
-                'destination_number': destination_number,
-                'start_time': start_time,
-                'answer_time': answer_time,
-                'end_time': end_time,
-                'progress_time': progress_time,
-                'progress_media_time': progress_media_time,
-                'duration': duration,
-                'sip_network_ip': sip_network_ip,
-                'sip_network_port': sip_network_port,
-                'sip_local_network_addr': sip_local_network_addr,
-                'transport': transport,
-                'remote_media_ip': remote_media_ip,
-                'remote_media_port': remote_media_port,
-                'local_media_ip': local_media_ip,
-                'local_media_port': local_media_port,
-                'read_codec': read_codec,
-                'write_codec': write_codec,
-                'rtp_crypto': rtp_crypto,
-                'hangup_cause': hangup_cause,
-                'sip_resp_code' : sip_resp_code,
-                'disposition': disposition,
-                'status': status,
-            }
-            if access_authid: cdrdata['access_authid'] = access_authid
-            if access_srcip: cdrdata['access_srcip'] = access_srcip
-            if access_userid: cdrdata['access_userid'] = access_userid
+                backoff = reebackoff(waiting, attempt)
+                if attempt >= MAXRETRY-2:
+                    logger.warning(f"module=liberator, space=cdr, action=rdbhandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
+                time.sleep(backoff)
+
+    def refine(self):
+        try:
+            cdrdata = cdrrefine(self.details)
         except Exception as e:
             logger.error(f"module=liberator, space=cdr, class=CDRHandler, action=refine, uuid={self.uuid}, exception={e}, tracings={traceback.format_exc()}")
-            cdrdata = {}
+            cdrdata = CDRUnrefined()
         finally:
            self.cdrdata = cdrdata
 
-    def filesave(self):
+    def filesave(self, part=''):
         try:
-            filename = f'{cdrtimestamp()}.json'
-            cdrjson = json.dumps(self.details)
-            logger.info(f"module=liberator, space=cdr, action=filesave, data={cdrjson}, filename={filename}")
-            with open(f'{LOGDIR}/cdr/{filename}', "a") as jsonfile:
-                jsonfile.write(cdrjson + '\n')
+            filename = f'{cdrtimestamp()}{part}.json{CDRSUFFIXES[DISKCDR_COMPRESSION]}'
+            cdrjson = jsoncodec.dumps(self.details)
+            logger.info(f"module=liberator, space=cdr, action=filesave, data={cdrjson.decode()}, filename={filename}")
+            with open(f'{LOGDIR}/cdr/{filename}', "ab") as jsonfile:
+                jsonfile.write(cdrcompressor(DISKCDR_COMPRESSION)(cdrjson + b'\n'))
         except Exception as e:
             logger.error(f"module=liberator, space=cdr, class=CDRHandler, action=filesave, exception={e}, tracings={traceback.format_exc()}")
 
     def httpsave(self):
-        headers = {'Content-Type': 'application/json', 'X-Signature': f'{_APPLICATION} {_SWVERSION}'}
-        endpoints = HTTPCDR_ENDPOINTS; shuffle(endpoints)
-        cdrjson = json.dumps(self.cdrdata)
-        status = 0; attempt = 0
-        for endpoint in endpoints:
-            attempt += 1; start = time.time()
-            try:
-                response = requests.post(endpoint, headers=headers, data=cdrjson, timeout=10, )
-                status = response.status_code
-                if status==200:
-                    shortcdr = {'uuid': self.cdrdata.get('uuid'), 'seshid': self.cdrdata.get('seshid')}
-                    end = time.time()
-                    logger.info(f"module=liberator, space=cdr, class=CDRHandler, action=httpsave, endpoint={endpoint}, status={status}, attempt={attempt}, shortcdr={shortcdr}, delay={round(end-start, 3)}")
-                    break
-            except Exception as e: # once exception occurred, log the error then retry
-                logger.warning(f"module=liberator, space=cdr, class=CDRHandler, action=httpsave, endpoint={endpoint}, status={status}, attempt={attempt}, exception={e}, tracings={traceback.format_exc()}")
-        # return result
-        if status==200: return True
-        else: return False
+        if cdrdedup.seen(self.uuid):
+            logger.info(f"module=liberator, space=cdr, class=CDRHandler, action=httpsave, state=duplicated, uuid={self.uuid}")
+            return True
+        response, endpoint, attempt, delay = httppost(CDRPayload([self.cdrdata]), self.uuid)
+        if response is None: return False
+        cdrdedup.add([self.uuid])
+        shortcdr = {'uuid': self.cdrdata.get('uuid'), 'seshid': self.cdrdata.get('seshid')}
+        logger.info(f"module=liberator, space=cdr, class=CDRHandler, action=httpsave, endpoint={endpoint}, status={response.status_code}, attempt={attempt}, shortcdr={shortcdr}, delay={delay}")
+        return True
 
     def rclean(self):
         try:
-            rdbconn = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD, decode_responses=True)
             pipe = rdbconn.pipeline()
-            pipe.zrem('cdr:inprogress', self.uuid)
-            pipe.delete(f'cdr:detail:{self.uuid}')
+            if self.entryid:
+                pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, self.entryid)
+                pipe.xdel(CDRSTREAM, self.entryid)
+            else:
+                pipe.zrem('cdr:inprogress', self.uuid)
+                pipe.delete(f'cdr:detail:{self.uuid}')
+                if CDRQUEUE_RELIABLE: pipe.lrem(CDRPROCESSING, 1, self.uuid)
             pipe.execute()
             result = True
         except Exception as e:
@@ -423,40 +1135,887 @@ class CDRHandler(Thread):
         return result
 
 
+class CDRSessionRecord(dict):
+    """ merged document of the legs of a call """
+    def asdict(self):
+        return self
+
+
+def cdrsession(records):
+    # summary of the session as get_cdr_records give it, with the refined legs
+    inbound = next((record for record in records if record.direction == 'inbound'), None)
+    outbounds = [record for record in records if record.direction == 'outbound']
+    # the answered outbound leg, the last attempt otherwise
+    outbound = next((record for record in outbounds if record.answer_time), outbounds[-1] if outbounds else None)
+    base = inbound or outbound or records[0]
+    return CDRSessionRecord({
+        'seshid': base.seshid,
+        'start_time': base.start_time,
+        'end_time': base.end_time,
+        'answer_time': base.answer_time,
+        'duration': base.duration,
+        'caller_number': (inbound or base).caller_number,
+        'destination_number': (inbound or base).destination_number,
+        'from_intcon': inbound.intconname if inbound else None,
+        'to_intcon': outbound.intconname if outbound else None,
+        'gateway': outbound.gateway if outbound else None,
+        'hangup_cause': base.hangup_cause,
+        'sip_resp_code': base.sip_resp_code,
+        'status': base.status,
+        'legs': [record.asdict() for record in records],
+    })
+
+
+class CDRSession:
+    """ legs of a call joined by seshid, the sinks take it as a single cdr and acknowledge every leg """
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.sinks = handlers[0].sinks
+        self.cdrdata = cdrsession([handler.cdrdata for handler in handlers])
+        # identify the session for http idempotency and sink logs
+        self.uuid = self.cdrdata['seshid']
+
+    httpsave = CDRHandler.httpsave
+
+    def legs(self):
+        return self.handlers
+
+    def acknowledge(self, sink, success):
+        for handler in self.handlers:
+            handler.acknowledge(sink, success)
+
+
+class CDRJoiner(Thread):
+    """ hold refined legs by seshid until no leg of the call arrived for window second, then send them as one session """
+    def __init__(self, window, maxsize):
+        self.stop = False
+        self.window = window
+        self.maxsize = maxsize
+        self.lock = Lock()
+        # seshid -> (last arrival time, handlers), least recently updated first so expiry stop at the first one in window
+        self.sessions = OrderedDict()
+        self.joined = 0
+        Thread.__init__(self)
+        self.setName('CDRJoiner')
+
+    def emit(self, handlers):
+        record = CDRSession(handlers) if len(handlers) > 1 else handlers[0]
+        if len(handlers) > 1: self.joined += 1
+        for sink in record.sinks:
+            sink.submit(record)
+
+    def submit(self, handler):
+        cdrdata = handler.cdrdata
+        seshid = cdrdata.get('seshid')
+        # cdr that failed the refinement or not part of a session are not held
+        if not seshid or not isinstance(cdrdata, CDRRecord) or cdrdrain.active:
+            self.emit([handler])
+            return
+        evicted = []
+        with self.lock:
+            # inbound and outbound legs are not enough, a failover outbound leg may still come
+            arrival, handlers = self.sessions.get(seshid, (None, []))
+            handlers.append(handler)
+            self.sessions[seshid] = (time.time(), handlers)
+            self.sessions.move_to_end(seshid)
+            while len(self.sessions) > self.maxsize:
+                evicted.append(self.sessions.popitem(last=False)[1][1])
+        for handlers in evicted:
+            self.emit(handlers)
+
+    def expire(self, everything=False):
+        # sessions without new leg within window are sent, with the legs they have
+        cutoff = time.time() - self.window
+        expired = []
+        with self.lock:
+            while self.sessions:
+                seshid, (arrival, handlers) = next(iter(self.sessions.items()))
+                if not everything and arrival >= cutoff: break
+                expired.append(handlers)
+                del self.sessions[seshid]
+        for handlers in expired:
+            self.emit(handlers)
+        return len(expired)
+
+    def stats(self):
+        joined, self.joined = self.joined, 0
+        return {'joined': joined, 'waiting': len(self.sessions)}
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_joiner_thread, window={self.window}, maxsize={self.maxsize}")
+        while not self.stop:
+            # on drain the legs in hand are not held any longer
+            self.expire(cdrdrain.active)
+            time.sleep(0.5)
+        self.expire(True)
+
+
+def qcollect(queue, size, wait):
+    # wait up to 1 second for the first item, then up to wait second or size items for the rest
+    items = []
+    try: items.append(queue.get(timeout=1))
+    except Empty: return items
+    deadline = time.time() + wait
+    while len(items) < size:
+        remaining = deadline - time.time()
+        if remaining <= 0: break
+        try: items.append(queue.get(timeout=remaining))
+        except Empty: break
+    return items
+
+
+class CDRCleaner(Thread):
+    """ remove delivered cdr from redis, many of them per pipelined call """
+    def __init__(self, interval, batchsize):
+        self.stop = False
+        self.interval = interval/1000
+        self.batchsize = batchsize
+        self.items = Queue()
+        # counters since the last report
+        self.flushes = 0
+        self.cleaned = 0
+        self.latency = 0
+        self.maxlatency = 0
+        Thread.__init__(self)
+        self.setName('CDRCleaner')
+
+    def submit(self, uuid, entryid=None):
+        self.items.put((uuid, entryid))
+
+    def stats(self):
+        flushes, cleaned, latency, maxlatency = self.flushes, self.cleaned, self.latency, self.maxlatency
+        self.flushes = self.cleaned = self.latency = self.maxlatency = 0
+        return {'flushes': flushes, 'cleaned': cleaned, 'pending': self.items.qsize(),
+                'avgsize': round(cleaned/flushes, 1) if flushes else 0,
+                'avglatency': round(latency/flushes*1000, 3) if flushes else 0,
+                'maxlatency': round(maxlatency*1000, 3)}
+
+    def flush(self, items):
+        uuids = [uuid for uuid, entryid in items if not entryid]
+        entryids = [entryid for uuid, entryid in items if entryid]
+        pipe = rdbconn.pipeline(transaction=False)
+        if uuids:
+            pipe.zrem('cdr:inprogress', *uuids)
+            pipe.delete(*[f'cdr:detail:{uuid}' for uuid in uuids])
+            if CDRQUEUE_RELIABLE:
+                for uuid in uuids: pipe.lrem(CDRPROCESSING, 1, uuid)
+        if entryids:
+            pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, *entryids)
+            pipe.xdel(CDRSTREAM, *entryids)
+        pipe.execute()
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_cleaner_thread, interval={self.interval}, batchsize={self.batchsize}")
+        while True:
+            items = qcollect(self.items, self.batchsize, self.interval)
+            if not items:
+                if self.stop: break
+                continue
+            waiting = 5; attempt = 0
+            while attempt < MAXRETRY:
+                start = time.time()
+                try:
+                    self.flush(items)
+                    latency = time.time() - start
+                    self.flushes += 1; self.cleaned += len(items); self.latency += latency
+                    self.maxlatency = max(self.maxlatency, latency)
+                    break
+                except Exception as e:
+                    attempt += 1
+                    backoff = reebackoff(waiting, attempt)
+                    logger.warning(f"module=liberator, space=cdr, class=CDRCleaner, action=flush, state=stuck, size={len(items)}, attempted={attempt}, backoff={backoff}, exception={e}")
+                    if self.stop or attempt >= MAXRETRY:
+                        # cdr is already delivered, leftover is removed by orphan cleanup or expired
+                        logger.error(f"module=liberator, space=cdr, class=CDRCleaner, action=flush, state=abandoned, uuids={[uuid for uuid, entryid in items]}")
+                        break
+                    time.sleep(backoff)
+
+
+class CDRFileWriter(Thread):
+    """ single writer of cdr files, lines of many handlers are committed with one write and fsync """
+    def __init__(self, flushinterval, flushsize, compression='none', part=''):
+        self.stop = False
+        # part of the file name after the window, a writer per process never share a file
+        self.part = part
+        self.flushinterval = flushinterval/1000
+        self.flushsize = flushsize*1024
+        self.suffix = CDRSUFFIXES[compression]
+        self.compress = cdrcompressor(compression)
+        self.entries = Queue(maxsize=CDRWORKER_QUEUESIZE)
+        self.cdrfile = None
+        self.boundary = 0
+        Thread.__init__(self)
+        self.setName('CDRFileWriter')
+
+    def submit(self, handler, cdrsaved, callback=None):
+        # once committed, callback(committed) is called if given, handler.release(cdrsaved) otherwise
+        cdrjson = jsoncodec.dumps(handler.details)
+        logger.info(f"module=liberator, space=cdr, action=filesave, data={cdrjson.decode()}")
+        while not self.stop:
+            try:
+                self.entries.put((time.time(), cdrjson + b'\n', handler, cdrsaved, callback), timeout=1)
+                return
+            except Full:
+                continue
+        # writer is stopping, fallback to the direct write
+        handler.filesave(self.part)
+        if callback: callback(True)
+        else: handler.release(cdrsaved)
+
+    def rotate(self, timestamp):
+        if self.cdrfile:
+            self.commit()
+            self.cdrfile.close()
+        filename, self.boundary = cdrwindow(datetime.fromtimestamp(timestamp))
+        self.cdrfile = open(f'{LOGDIR}/cdr/{filename}{self.part}.json{self.suffix}', 'ab')
+        logger.info(f"module=liberator, space=cdr, class=CDRFileWriter, action=rotate, filename={filename}{self.part}.json{self.suffix}, boundary={fmtime(self.boundary)}")
+
+    def commit(self):
+        self.cdrfile.flush()
+        os.fsync(self.cdrfile.fileno())
+
+    def flush(self, entries):
+        committed = False
+        try:
+            chunk = []
+            for timestamp, line, handler, cdrsaved, callback in entries:
+                if timestamp >= self.boundary:
+                    if chunk:
+                        self.cdrfile.write(self.compress(b''.join(chunk))); chunk = []
+                    self.rotate(timestamp)
+                chunk.append(line)
+            # one frame per flush, so a reader can always decode up to the last commit
+            self.cdrfile.write(self.compress(b''.join(chunk)))
+            self.commit()
+            committed = True
+        except Exception as e:
+            logger.error(f"module=liberator, space=cdr, class=CDRFileWriter, action=flush, size={len(entries)}, exception={e}, tracings={traceback.format_exc()}")
+            # reopen on next flush
+            self.boundary = 0
+        # undeliverable cdr of the flush go to the spool with a single write and fsync
+        spooling = [handler for timestamp, line, handler, cdrsaved, callback in entries if not callback and handler.spoolable(cdrsaved)]
+        if spooling:
+            spooling[0].spool.append([handler.cdrdata for handler in spooling])
+        spooled = set(id(handler) for handler in spooling)
+        for timestamp, line, handler, cdrsaved, callback in entries:
+            try:
+                if callback: callback(committed)
+                else: handler.release(cdrsaved, id(handler) in spooled)
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRFileWriter, action=release, uuid={handler.uuid}, exception={e}, tracings={traceback.format_exc()}")
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_filewriter_thread, flushinterval={self.flushinterval}, flushsize={self.flushsize}")
+        while True:
+            # group every line that arrive within flushinterval of the first one, up to flushsize
+            try:
+                entry = self.entries.get(timeout=1)
+            except Empty:
+                if self.stop: break
+                continue
+            entries = [entry]; size = len(entry[1])
+            deadline = time.time() + self.flushinterval
+            while size < self.flushsize:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                try:
+                    entry = self.entries.get(timeout=remaining)
+                except Empty:
+                    break
+                entries.append(entry); size += len(entry[1])
+            self.flush(entries)
+        if self.cdrfile:
+            self.cdrfile.close()
+
+
+class CDRRetrier(Thread):
+    """ hold failed cdr until their backoff is due then put them back to the worker queue,
+        schedule is mirrored to redis so list transport can reload it after restart """
+    def __init__(self, cdrqueue):
+        self.stop = False
+        self.cdrqueue = cdrqueue
+        self.heap = []
+        self.sequence = count()
+        self.condition = Condition()
+        Thread.__init__(self)
+        self.setName('CDRRetrier')
+
+    def schedule(self, handlers, backoff):
+        due = time.time() + backoff
+        try:
+            rdbconn.zadd(CDRRETRY, {handler.uuid: due for handler in handlers})
+        except Exception as e:
+            logger.warning(f"module=liberator, space=cdr, class=CDRRetrier, action=schedule, uuids={[handler.uuid for handler in handlers]}, exception={e}")
+        with self.condition:
+            for handler in handlers:
+                heapq.heappush(self.heap, (due, next(self.sequence), handler))
+            self.condition.notify()
+
+    def reload(self, handlerof, owned=None):
+        # only list transport without reliable queue need it, others recover their cdr by processing list or pending entries
+        # with worker processes, each one reload the cdr it own and the parent clear the schedule
+        if CDR_TRANSPORT != 'list' or CDRQUEUE_RELIABLE:
+            if owned is None: rdbconn.delete(CDRRETRY)
+            return 0
+        schedules = rdbconn.zrange(CDRRETRY, 0, -1, withscores=True)
+        if owned: schedules = [(uuid, due) for uuid, due in schedules if owned(uuid)]
+        if not schedules: return 0
+        detail_values = rdbconn.mget([f'cdr:detail:{uuid}' for uuid, due in schedules])
+        with self.condition:
+            for (uuid, due), detail_value in zip(schedules, detail_values):
+                if detail_value:
+                    handler = handlerof(uuid, jsoncodec.loads(detail_value), None)
+                    handler.attempt = 1
+                    heapq.heappush(self.heap, (due, next(self.sequence), handler))
+                else:
+                    rdbconn.zrem(CDRRETRY, uuid)
+            self.condition.notify()
+        logger.info(f"module=liberator, space=cdr, class=CDRRetrier, action=reload, scheduled={len(self.heap)}")
+        return len(self.heap)
+
+    def pending(self):
+        return len(self.heap)
+
+    def expedite(self):
+        # every scheduled cdr is due now
+        with self.condition:
+            self.heap = [(0, sequence, handler) for due, sequence, handler in self.heap]
+            heapq.heapify(self.heap)
+            self.condition.notify()
+
+    def handback(self):
+        with self.condition:
+            handlers = [handler for due, sequence, handler in sorted(self.heap)]
+            self.heap = []
+        return handlers
+
+    def run(self):
+        while not self.stop:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait(1)
+                    continue
+                wait = self.heap[0][0] - time.time()
+                if wait > 0:
+                    self.condition.wait(min(wait, 1))
+                    continue
+                due, sequence, handler = heapq.heappop(self.heap)
+            # redispatch, blocking while worker queue is full
+            while not self.stop:
+                try:
+                    self.cdrqueue.put(handler, timeout=1)
+                    break
+                except Full:
+                    continue
+            else:
+                # stopping, the schedule is kept in redis
+                return
+            try:
+                rdbconn.zrem(CDRRETRY, handler.uuid)
+            except Exception as e:
+                logger.warning(f"module=liberator, space=cdr, class=CDRRetrier, action=redispatch, uuid={handler.uuid}, exception={e}")
+
+
+class CDRBatcher(Thread):
+    """ collect refined cdr and deliver them to http endpoints as a single request """
+    def __init__(self, batchsize, batchwait, batchformat, retrier):
+        self.stop = False
+        self.batchsize = batchsize
+        self.batchwait = batchwait/1000
+        self.batchformat = batchformat
+        self.retrier = retrier
+        self.handlers = Queue(maxsize=CDRWORKER_QUEUESIZE)
+        Thread.__init__(self)
+        self.setName('CDRBatcher')
+
+    def submit(self, handler):
+        while not self.stop:
+            try:
+                self.handlers.put(handler, timeout=1)
+                return
+            except Full:
+                continue
+        # batcher is stopping, fallback to the ordinary per-cdr delivery
+        handler.finalize(handler.save())
+
+    def post(self, pending, attempt):
+        return httpbatch(pending, self.batchformat, attempt)
+
+    def flush(self, batch):
+        # single attempt per batch, failed cdr wait in the retrier then come back through the worker queue into a later batch
+        attempt = max(handler.attempt for handler in batch) + 1
+        pending = batch if self.stop else self.post(batch, attempt)
+        failures = set(handler.uuid for handler in pending)
+        retrying = []
+        for handler in batch:
+            handler.attempt += 1
+            if handler.uuid in failures and handler.attempt < MAXRETRY and not cdrdrain.active and not self.stop:
+                retrying.append(handler)
+                continue
+            try:
+                handler.finalize(handler.uuid not in failures)
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRBatcher, action=flush, uuid={handler.uuid}, exception={e}, tracings={traceback.format_exc()}")
+        if retrying:
+            backoff = reebackoff(5, attempt)
+            if attempt >= MAXRETRY-2:
+                logger.warning(f"module=liberator, space=cdr, class=CDRBatcher, action=flush, state=stuck, size={len(retrying)}, attempted={attempt}, backoff={backoff}")
+            self.retrier.schedule(retrying, backoff)
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_batcher_thread, batchsize={self.batchsize}, batchwait={self.batchwait}, format={self.batchformat}")
+        while True:
+            batch = qcollect(self.handlers, self.batchsize, self.batchwait)
+            if batch:
+                self.flush(batch)
+            elif self.stop:
+                break
+
+
+class CDRSpool:
+    """ append-only spool of refined cdr, split into numbered segment files """
+    def __init__(self, spooldir, segmentsize):
+        self.spooldir = spooldir
+        self.segmentsize = segmentsize*1024*1024
+        self.lock = Lock()
+        os.makedirs(spooldir, exist_ok=True)
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.spoolfile = None
+
+    def segments(self):
+        return sorted(int(filename.split('.')[0]) for filename in os.listdir(self.spooldir) if filename.endswith('.spool'))
+
+    def path(self, segment):
+        return f'{self.spooldir}/{segment:010d}.spool'
+
+    def sync(self):
+        self.spoolfile.flush()
+        os.fsync(self.spoolfile.fileno())
+
+    def append(self, cdrdatas):
+        # cdr are written together and made durable with a single fsync
+        uuids = [cdrdata.get('uuid') for cdrdata in cdrdatas]
+        try:
+            lines = [jsoncodec.dumps(cdrdata.asdict()) + b'\n' for cdrdata in cdrdatas]
+            with self.lock:
+                if self.spoolfile is None:
+                    self.spoolfile = open(self.path(self.segment), 'ab')
+                for line in lines:
+                    # rotate, next segment is created by the write
+                    if self.spoolfile.tell() and self.spoolfile.tell() + len(line) > self.segmentsize:
+                        self.sync()
+                        self.spoolfile.close()
+                        self.segment += 1
+                        self.spoolfile = open(self.path(self.segment), 'ab')
+                    self.spoolfile.write(line)
+                self.sync()
+            logger.info(f"module=liberator, space=cdr, class=CDRSpool, action=append, uuids={uuids}, segment={self.segment}")
+            return True
+        except Exception as e:
+            logger.error(f"module=liberator, space=cdr, class=CDRSpool, action=append, uuids={uuids}, exception={e}, tracings={traceback.format_exc()}")
+            return False
+
+    def writing(self):
+        with self.lock:
+            return self.segment
+
+    def checkpoint(self):
+        # read position of replayer: segment and byte offset of the next cdr to send
+        try:
+            with open(f'{self.spooldir}/checkpoint') as cpfile:
+                segment, offset = cpfile.read().split()
+                return int(segment), int(offset)
+        except FileNotFoundError:
+            segments = self.segments()
+            return (segments[0] if segments else self.writing()), 0
+
+    def commit(self, segment, offset):
+        # write then rename, so a crash never leave a partial checkpoint
+        tmpfile = f'{self.spooldir}/checkpoint.tmp'
+        with open(tmpfile, 'w') as cpfile:
+            cpfile.write(f'{segment} {offset}')
+            cpfile.flush()
+            os.fsync(cpfile.fileno())
+        os.replace(tmpfile, f'{self.spooldir}/checkpoint')
+
+
+class CDRReplayer(Thread):
+    """ send spooled cdr to http endpoints again, at most replayrate cdr per second """
+    def __init__(self, spool, replayrate):
+        self.stop = False
+        self.spool = spool
+        self.interval = 1/replayrate
+        Thread.__init__(self)
+        self.setName('CDRReplayer')
+
+    def pause(self, seconds):
+        # sleep that is interrupted by stop
+        until = time.time() + seconds
+        while not self.stop and time.time() < until:
+            time.sleep(min(1, until - time.time()))
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_replayer_thread, spooldir={self.spool.spooldir}, interval={self.interval}")
+        segment, offset = self.spool.checkpoint()
+        committed = (segment, offset); last_commit_time = 0
+        spoolfile = None; attempt = 0
+        while not self.stop:
+            try:
+                if spoolfile is None:
+                    if not os.path.exists(self.spool.path(segment)):
+                        # segment is not yet written, or it was removed
+                        following = [number for number in self.spool.segments() if number > segment]
+                        if following:
+                            segment, offset = following[0], 0
+                        else:
+                            self.pause(1)
+                        continue
+                    spoolfile = open(self.spool.path(segment), 'rb')
+                    spoolfile.seek(offset)
+                line = spoolfile.readline()
+                if line.endswith(b'\n'):
+                    uuid = jsoncodec.loads(line).get('uuid')
+                    if uuid and cdrdedup.seen(uuid):
+                        # delivered by a later attempt or before a crash
+                        offset += len(line)
+                        logger.info(f"module=liberator, space=cdr, class=CDRReplayer, action=replay, state=duplicated, uuid={uuid}, segment={segment}, offset={offset}")
+                        continue
+                    response, endpoint, _attempt, delay = httppost(CDRPayload(None, jsonline=line), uuid)
+                    if response is None:
+                        # endpoints are still down, hold the position
+                        attempt += 1
+                        spoolfile.seek(offset)
+                        self.pause(reebackoff(5, min(attempt, MAXRETRY)))
+                        continue
+                    if attempt:
+                        logger.info(f"module=liberator, space=cdr, class=CDRReplayer, action=replay, state=recovered, attempted={attempt}")
+                    attempt = 0
+                    offset += len(line)
+                    if uuid: cdrdedup.add([uuid])
+                    logger.info(f"module=liberator, space=cdr, class=CDRReplayer, action=replay, endpoint={endpoint}, segment={segment}, offset={offset}, delay={delay}")
+                    self.pause(self.interval)
+                elif segment < self.spool.writing():
+                    # segment is fully replayed and no longer written, move on and remove it
+                    spoolfile.close(); spoolfile = None
+                    os.remove(self.spool.path(segment))
+                    segment, offset = segment + 1, 0
+                else:
+                    # end of writing segment, or partial line being written
+                    spoolfile.seek(offset)
+                    self.pause(1)
+                # checkpoint at most once per second, a crash replay cdr sent after the last checkpoint
+                current_time = time.time()
+                if (segment, offset) != committed and (current_time - last_commit_time >= 1):
+                    self.spool.commit(segment, offset)
+                    committed = (segment, offset); last_commit_time = current_time
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRReplayer, action=run, segment={segment}, offset={offset}, exception={e}, tracings={traceback.format_exc()}")
+                if spoolfile: spoolfile.close()
+                spoolfile = None
+                self.pause(5)
+        try:
+            if spoolfile: spoolfile.close()
+            if (segment, offset) != committed:
+                self.spool.commit(segment, offset)
+        except Exception as e:
+            logger.error(f"module=liberator, space=cdr, class=CDRReplayer, action=stop, segment={segment}, offset={offset}, exception={e}")
+
+
+class CDRBackfill(Thread):
+    """ tail raw cdr files that callng write while redis is unreachable, and queue their cdr as callng would have """
+    def __init__(self, cdrdir, interval, batchsize):
+        self.stop = False
+        self.cdrdir = cdrdir
+        self.interval = interval
+        self.batchsize = batchsize
+        Thread.__init__(self)
+        self.setName('CDRBackfill')
+
+    def pause(self, seconds):
+        until = time.time() + seconds
+        while not self.stop and time.time() < until:
+            time.sleep(min(1, until - time.time()))
+
+    def push(self, filename, offset, lines):
+        # cdr and the new offset are written in one transaction, so a line is never queued twice
+        pipe = rdbconn.pipeline(transaction=True)
+        for line in lines:
+            try:
+                uuid = jsoncodec.loads(line)['uuid']
+            except (*jsoncodec.DecodeError, KeyError, TypeError) as e:
+                logger.warning(f"module=liberator, space=cdr, class=CDRBackfill, action=push, filename={filename}, state=skipped, line={line[:256]}, exception={e}")
+                continue
+            detail = line.rstrip(b'\n').decode()
+            if CDR_TRANSPORT == 'stream':
+                pipe.xadd(CDRSTREAM, {'uuid': uuid, 'detail': detail})
+            else:
+                pipe.setex(f'cdr:detail:{uuid}', CDRTTL, detail)
+                pipe.rpush('cdr:queue:new', uuid)
+        pipe.hset(CDRBACKFILL, filename, offset)
+        pipe.execute()
+
+    def backfill(self, filename, offset):
+        with open(f'{self.cdrdir}/{filename}', 'rb') as rawfile:
+            rawfile.seek(offset)
+            while not self.stop:
+                lines = []
+                while len(lines) < self.batchsize:
+                    line = rawfile.readline()
+                    # partial line is being written, it is taken on the next scan
+                    if not line.endswith(b'\n'): break
+                    lines.append(line)
+                if not lines: break
+                offset += sum(len(line) for line in lines)
+                self.push(filename, offset, lines)
+                logger.info(f"module=liberator, space=cdr, class=CDRBackfill, action=backfill, filename={filename}, offset={offset}, size={len(lines)}")
+
+    def scan(self):
+        offsets = {filename: int(offset) for filename, offset in rdbconn.hgetall(CDRBACKFILL).items()}
+        filenames = sorted(filename for filename in os.listdir(self.cdrdir) if filename.endswith('.cdr.raw.json'))
+        removed = set(offsets) - set(filenames)
+        if removed: rdbconn.hdel(CDRBACKFILL, *removed)
+        for filename in filenames:
+            if self.stop: break
+            offset = offsets.get(filename, 0)
+            size = os.path.getsize(f'{self.cdrdir}/{filename}')
+            if size < offset:
+                logger.warning(f"module=liberator, space=cdr, class=CDRBackfill, action=scan, filename={filename}, state=truncated, offset={offset}, size={size}")
+                offset = 0
+            if size > offset:
+                self.backfill(filename, offset)
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_backfill_thread, cdrdir={self.cdrdir}, interval={self.interval}")
+        while not self.stop:
+            try:
+                self.scan()
+            except redis.RedisError as e:
+                # redis is still unreachable, the offset is kept and the file scanned again
+                logger.warning(f"module=liberator, space=cdr, class=CDRBackfill, action=scan, exception={e}")
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRBackfill, action=scan, exception={e}, tracings={traceback.format_exc()}")
+            self.pause(self.interval)
+
+
+class CDRWorker(Thread):
+    """ long-lived thread that take cdr handler from the shared queue and run it """
+    def __init__(self, workerid, cdrqueue):
+        self._halted = False
+        self.handler = None
+        self.cdrqueue = cdrqueue
+        Thread.__init__(self)
+        self.setName(f'CDRWorker-{workerid}')
+
+    # stop flag is propagated to the running handler, so it break the retry loops
+    @property
+    def stop(self):
+        return self._halted
+
+    @stop.setter
+    def stop(self, value):
+        self._halted = value
+        handler = self.handler
+        if handler: handler.stop = value
+
+    def run(self):
+        while not self.stop:
+            try:
+                handler = self.cdrqueue.get(timeout=1)
+            except Empty:
+                continue
+            try:
+                self.handler = handler
+                handler.stop = self.stop
+                handler.run()
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRWorker, action=run, uuid={handler.uuid}, exception={e}, tracings={traceback.format_exc()}")
+            finally:
+                self.handler = None
+                self.cdrqueue.task_done()
+
+
 class CDRMaster(Thread):
     def __init__(self):
         self.stop = False
+        self.cdrqueue = Queue(maxsize=CDRWORKER_QUEUESIZE)
+        self.workers = []
+        self.batcher = None
+        self.cleaner = None
+        self.retrier = None
+        self.spool = None
+        self.replayer = None
+        self.backfiller = None
+        self.filewriter = None
+        self.sinks = []
+        self.joiner = None
+        self.last_cleanup_time = 0
+        self.deadline = 0
+        self.spooldir = CDRSPOOLDIR
+        # cdr file name part, eg: 2024-01-01.cdr.nice.1.json for worker process 1
+        self.filepart = ''
+        # node-wide duties, left to the parent process when it run as a worker process
+        self.backfilling = True
+        self.owned = None
         Thread.__init__(self)
         self.setName('CDRMaster')
 
-    def run(self):
-        logger.info(f"module=liberator, space=cdr, action=start_cdr_thread")
-        rdbconn = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD, decode_responses=True)
-        last_cleanup_time = 0
+    def handlerof(self, uuid, details, entryid=None):
+        cdrdrain.track(1)
+        return CDRHandler(uuid, details, self.batcher, entryid, self.cleaner, self.retrier, self.spool, self.filewriter, self.sinks, self.joiner)
+
+    def dispatch(self, uuid, details, entryid=None):
+        # block while the pool is saturated, that is the backpressure to redis queue
+        handler = self.handlerof(uuid, details, entryid)
         while not self.stop:
             try:
+                self.cdrqueue.put(handler, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def saturated(self):
+        return self.cdrqueue.full()
+
+    def drain(self, timeout=CDR_DRAIN_TIMEOUT):
+        # called on shutdown: stop ingesting, deliver or spool cdr in hand, flush writers, then stop
+        self.deadline = time.time() + timeout
+        cdrdrain.active = True
+        logger.info(f"module=liberator, space=cdr, action=drain, state=started, inhand={cdrdrain.inhand}, timeout={timeout}")
+        # ingest may be blocked on redis for REDIS_TIMEOUT
+        self.join(timeout + REDIS_TIMEOUT + 5)
+
+    def settle(self):
+        # failed cdr get one more attempt at once, they are spooled if it fail
+        self.retrier.expedite()
+        while cdrdrain.inhand > 0 and time.time() < self.deadline:
+            time.sleep(0.05)
+        # handlers that are not started by deadline are handed back to redis
+        handlers = self.retrier.handback()
+        while True:
+            try:
+                handlers.append(self.cdrqueue.get_nowait())
+                self.cdrqueue.task_done()
+            except Empty:
+                break
+        handedback = 0
+        if handlers:
+            cdrdrain.track(-len(handlers))
+            try:
+                handedback = cdrrequeue(rdbconn, [(handler.uuid, handler.entryid) for handler in handlers])
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRMaster, action=drain, state=handback, size={len(handlers)}, exception={e}")
+        return len(handlers), handedback
+
+    def vacancy(self):
+        return max(CDRWORKER_QUEUESIZE - self.cdrqueue.qsize(), 1)
+
+    def prepare(self, rdbconn):
+        if CDRQUEUE_RELIABLE:
+            cdrrecover(rdbconn)
+
+    def maintain(self, rdbconn, current_time):
+        if (current_time - self.last_cleanup_time) > CDRTTL:
+            cutoff_time = int(current_time) - CDRTTL
+            recovered, lost = cdrsweep(rdbconn, cutoff_time)
+            if recovered or lost:
+                logger.info(f"module=liberator, space=cdr, action=periodic_cleanup, orphans_recovered={recovered}, orphans_lost={lost}")
+            self.last_cleanup_time = current_time
+
+    def ingest(self, rdbconn, batchsize):
+        uuids = cdrtake(rdbconn, batchsize)
+        if not uuids: return []
+        # mark in progress and fetch all details in a single round trip
+        score = int(time.time())
+        pipe = rdbconn.pipeline(transaction=False)
+        pipe.zadd('cdr:inprogress', {uuid: score for uuid in uuids})
+        pipe.mget([f'cdr:detail:{uuid}' for uuid in uuids])
+        _, detail_values = pipe.execute()
+        return [(uuid, detail_value, None) for uuid, detail_value in zip(uuids, detail_values)]
+
+    def discard(self, rdbconn, lostentries):
+        lostuuids = [uuid for uuid, entryid in lostentries]
+        rdbconn.zrem('cdr:inprogress', *lostuuids)
+        if CDRQUEUE_RELIABLE:
+            for uuid in lostuuids: rdbconn.lrem(CDRPROCESSING, 1, uuid)
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_cdr_thread, poolsize={CDRWORKER_POOLSIZE}, queuesize={CDRWORKER_QUEUESIZE}")
+        self.cleaner = CDRCleaner(CDRCLEAN_INTERVAL, CDRCLEAN_BATCHSIZE)
+        self.cleaner.start()
+        self.filewriter = CDRFileWriter(DISKCDR_FLUSHINTERVAL, DISKCDR_FLUSHSIZE, DISKCDR_COMPRESSION, self.filepart)
+        self.filewriter.start()
+        if CDR_SINKS:
+            from cdrsink import cdrsinks
+            self.sinks = cdrsinks(CDR_SINKS, self.filewriter)
+            for sink in self.sinks: sink.start()
+            if CDRJOIN_WINDOW:
+                self.joiner = CDRJoiner(CDRJOIN_WINDOW, CDRJOIN_MAXSIZE)
+                self.joiner.start()
+        self.retrier = CDRRetrier(self.cdrqueue)
+        self.retrier.start()
+        if HTTPCDR_ENDPOINTS and HTTPCDR_BATCHSIZE > 1 and not CDR_SINKS:
+            self.batcher = CDRBatcher(HTTPCDR_BATCHSIZE, HTTPCDR_BATCHWAIT, HTTPCDR_BATCHFORMAT, self.retrier)
+            self.batcher.start()
+        if HTTPCDR_ENDPOINTS:
+            self.spool = CDRSpool(self.spooldir, CDRSPOOL_SEGMENTSIZE)
+            if CDRSPOOL_REPLAYRATE:
+                self.replayer = CDRReplayer(self.spool, CDRSPOOL_REPLAYRATE)
+                self.replayer.start()
+        if CDRKPI_WINDOW:
+            cdrkpi.start()
+        if CDRDEDUP_WINDOW:
+            cdrdedup.start()
+        if CDRBACKFILL_INTERVAL and self.backfilling:
+            self.backfiller = CDRBackfill(f'{LOGDIR}/cdr', CDRBACKFILL_INTERVAL, CDRINGEST_BATCHSIZE)
+            self.backfiller.start()
+        for workerid in range(CDRWORKER_POOLSIZE):
+            worker = CDRWorker(workerid, self.cdrqueue)
+            worker.start()
+            self.workers.append(worker)
+
+        prepared = False
+        last_stats_time = time.time()
+        while not self.stop and not cdrdrain.active:
+            try:
+                if not prepared:
+                    self.prepare(rdbconn)
+                    cdrdedup.load(rdbconn)
+                    self.retrier.reload(self.handlerof, self.owned)
+                    prepared = True
                 current_time = time.time()
-                if (current_time - last_cleanup_time) > CDRTTL:
-                    cutoff_time = int(current_time) - CDRTTL
-                    removed = rdbconn.zremrangebyscore('cdr:inprogress', '-inf', cutoff_time)
-                    if removed > 0:
-                        logger.info(f"module=liberator, space=cdr, action=periodic_cleanup, orphans_removed={removed}")
-                    last_cleanup_time = current_time
-                reply = rdbconn.blpop('cdr:queue:new', REDIS_TIMEOUT)
-                if reply:
-                    uuid = reply[1]
-                    score = int(time.time())
-                    rdbconn.zadd('cdr:inprogress', {uuid: score})
-                    detail_key = f'cdr:detail:{uuid}'
-                    detail_value = rdbconn.get(detail_key)
+                if (current_time - last_stats_time) > 60:
+                    for endpoint, stats in httpstats().items():
+                        logger.info(f"module=liberator, space=cdr, action=httpstats, endpoint={endpoint}, requests={stats['requests']}, connections={stats['connections']}, reuse={stats['reuse']}")
+                    for endpoint, stats in endpointstats().items():
+                        logger.info(f"module=liberator, space=cdr, action=endpointstats, endpoint={endpoint}, state={stats['state']}, latency={stats['latency']}, errorrate={stats['errorrate']}, inflight={stats['inflight']}, limit={stats['limit']}, encoding={stats['encoding']}")
+                    if self.joiner:
+                        stats = self.joiner.stats()
+                        logger.info(f"module=liberator, space=cdr, action=joinstats, joined={stats['joined']}, waiting={stats['waiting']}")
+                    for sink in self.sinks:
+                        stats = sink.stats()
+                        logger.info(f"module=liberator, space=cdr, action=sinkstats, sink={sink.name}, pending={stats['pending']}, dropped={stats['dropped']}")
+                    stats = self.cleaner.stats()
+                    logger.info(f"module=liberator, space=cdr, action=retrystats, pending={self.retrier.pending()}")
+                    logger.info(f"module=liberator, space=cdr, action=cleanstats, flushes={stats['flushes']}, cleaned={stats['cleaned']}, pending={stats['pending']}, avgsize={stats['avgsize']}, avglatency={stats['avglatency']}ms, maxlatency={stats['maxlatency']}ms")
+                    last_stats_time = current_time
+                self.maintain(rdbconn, current_time)
+                # do not take more cdr from redis until a worker is free
+                if self.saturated():
+                    time.sleep(0.05)
+                    continue
+                lostentries = []
+                for uuid, detail_value, entryid in self.ingest(rdbconn, min(CDRINGEST_BATCHSIZE, self.vacancy())):
                     if detail_value:
-                        details = json.loads(detail_value)
+                        details = jsoncodec.loads(detail_value)
                         # write cdr
-                        handler = CDRHandler(uuid, details)
-                        handler.start()
+                        self.dispatch(uuid, details, entryid)
                     else:
                         logger.warning(f"module=liberator, space=cdr, action=cdrmaster, state=detail_expired, uuid={uuid}, note=CDR_LOST")
-                        rdbconn.zrem('cdr:inprogress', uuid)
+                        lostentries.append((uuid, entryid))
+                if lostentries:
+                    self.discard(rdbconn, lostentries)
             except redis.RedisError as e:
                 # wait and try again
                 time.sleep(5)
@@ -465,3 +2024,84 @@ class CDRMaster(Thread):
                 time.sleep(2)
             finally: pass
 
+        if cdrdrain.active:
+            left, handedback = self.settle()
+        for worker in self.workers:
+            worker.stop = True
+        if self.batcher:
+            self.batcher.stop = True
+        if self.joiner:
+            # held legs go to the sinks before they stop
+            self.joiner.stop = True
+            self.joiner.join(5)
+        for sink in self.sinks:
+            sink.stop = True
+        self.filewriter.stop = True
+        self.cleaner.stop = True
+        self.retrier.stop = True
+        if self.replayer:
+            self.replayer.stop = True
+        if self.backfiller:
+            self.backfiller.stop = True
+        # counters and acknowledgements of the last seconds are added on its way out
+        cdrkpi.stop = True
+        cdrdedup.stop = True
+        if cdrdrain.active:
+            # file writer and cleaner empty their queue before they exit
+            self.filewriter.join(5)
+            self.cleaner.join(5)
+            logger.info(f"module=liberator, space=cdr, action=drain, state=done, completed={cdrdrain.completed}, spooled={cdrdrain.spooled}, filed={cdrdrain.filed}, "
+                        f"inqueue={left}, handedback={handedback}, unfinished={cdrdrain.inhand}")
+
+
+class CDRStreamMaster(CDRMaster):
+    """ consume cdr:stream as a member of a consumer group, the load is shared between liberator nodes """
+    def __init__(self):
+        CDRMaster.__init__(self)
+        self.setName('CDRStreamMaster')
+        # cursor of own pending entries reading, None once they are all dispatched
+        self.pending = '0'
+        self.last_claim_time = 0
+        # cursor of the scan for idle entries of other consumers, 0-0 once the whole stream is scanned
+        self.claimcursor = '0-0'
+
+    def prepare(self, rdbconn):
+        streamgroup(rdbconn)
+
+    def maintain(self, rdbconn, current_time):
+        pass
+
+    def ingest(self, rdbconn, batchsize):
+        # own pending entries first (left by previous run), they are read back with id 0
+        if self.pending:
+            reply = rdbconn.xreadgroup(CDR_STREAM_GROUP, CDR_CONSUMERID, {CDRSTREAM: self.pending}, count=batchsize)
+            history = reply[0][1] if reply else []
+            if history:
+                self.pending = history[-1][0]
+                # reset their idle time, so they are not claimed back while being delivered
+                rdbconn.xclaim(CDRSTREAM, CDR_STREAM_GROUP, CDR_CONSUMERID, 0, [entryid for entryid, fields in history], justid=True)
+                deleted = [entryid for entryid, fields in history if not fields]
+                if deleted: rdbconn.xack(CDRSTREAM, CDR_STREAM_GROUP, *deleted)
+                logger.info(f"module=liberator, space=cdr, action=stream_pending, consumer={CDR_CONSUMERID}, entries={len(history)}")
+                return streamentries(history)
+            self.pending = None
+        # entries idle for too long in other (dead) consumer
+        current_time = time.time()
+        # a scan that stopped at batchsize go on at once from where it was
+        if self.claimcursor != '0-0' or (current_time - self.last_claim_time) > CDR_STREAM_CLAIMIDLE/10:
+            self.last_claim_time = current_time
+            reply = rdbconn.xautoclaim(CDRSTREAM, CDR_STREAM_GROUP, CDR_CONSUMERID, CDR_STREAM_CLAIMIDLE*1000, start_id=self.claimcursor, count=batchsize)
+            self.claimcursor = reply[0]
+            entries = streamentries(reply[1])
+            if entries:
+                logger.info(f"module=liberator, space=cdr, action=stream_autoclaim, consumer={CDR_CONSUMERID}, entries={len(entries)}")
+                return entries
+        reply = rdbconn.xreadgroup(CDR_STREAM_GROUP, CDR_CONSUMERID, {CDRSTREAM: '>'}, count=batchsize, block=REDIS_TIMEOUT*1000)
+        return streamentries(reply[0][1]) if reply else []
+
+    def discard(self, rdbconn, lostentries):
+        entryids = [entryid for uuid, entryid in lostentries]
+        pipe = rdbconn.pipeline()
+        pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, *entryids)
+        pipe.xdel(CDRSTREAM, *entryids)
+        pipe.execute()
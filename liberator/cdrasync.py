@@ -0,0 +1,400 @@
+#
+# liberator:cdrasync.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+
+import time
+import traceback
+import asyncio
+from threading import Thread
+
+import httpx
+import redis
+import redis.asyncio as aioredis
+
+from configuration import (_APPLICATION, _SWVERSION, CDRTTL,
+                           REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, REDIS_TIMEOUT,
+                           HTTPCDR_ENDPOINTS, DISKCDR_ENABLE,
+                           HTTPCDR_POOLSIZE, HTTPCDR_CONNECT_TIMEOUT, HTTPCDR_READ_TIMEOUT, CDRSPOOL_REPLAYRATE, CDRSPOOL_SEGMENTSIZE,
+                           DISKCDR_FLUSHINTERVAL, DISKCDR_FLUSHSIZE, DISKCDR_COMPRESSION, CDR_ASYNC_INFLIGHT, CDRINGEST_BATCHSIZE, CDRQUEUE_RELIABLE,
+                           CDR_TRANSPORT, CDR_STREAM_GROUP, CDR_STREAM_CLAIMIDLE, CDR_CONSUMERID, CDR_SINKS, CDRBACKFILL_INTERVAL, LOGDIR, CDR_DRAIN_TIMEOUT,
+                           CDRKPI_WINDOW, CDRDEDUP_WINDOW)
+from utilities import logger
+import jsoncodec
+from cdrcodec import CDRPayload
+from cdr import (CDRHandler, CDRRecord, CDRSpool, CDRReplayer, CDRBackfill, CDRFileWriter, MAXRETRY, CDRPROCESSING, CDRSTREAM, CDRSPOOLDIR, reebackoff, cdrrecover,
+                 streamgroup, streamentries, endpointorder, endpointacquire, endpointwatch, endpointskip, endpointreport, endpointnegotiate, cdrdedup, cdrsweep, cdrdrain, cdrrequeue, cdrkpi)
+
+
+class AsyncCDRHandler(CDRHandler):
+    """ same refinement as CDRHandler, but deliver, write and clean without blocking the event loop """
+    def __init__(self, uuid, details, engine, entryid=None):
+        CDRHandler.__init__(self, uuid, details, entryid=entryid, spool=engine.spool)
+        self.engine = engine
+        # delivery is over, cdr is being written, spooled or cleaned
+        self.finalizing = False
+
+    async def arun(self):
+        try:
+            self.refine()
+            logger.info(f"module=liberator, space=cdrasync, action=cdrnotifier, uuid={self.uuid}, data={self.cdrdata}")
+            await self.afinalize(await self.asave())
+        except Exception as e:
+            logger.error(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=arun, uuid={self.uuid}, exception={e}, tracings={traceback.format_exc()}")
+
+    async def asave(self):
+        cdrsaved = True; waiting = 5; attempt = 0
+        while attempt < MAXRETRY and not self.engine.stop:
+            if HTTPCDR_ENDPOINTS:
+                cdrsaved = await self.ahttpsave()
+            attempt += 1
+            if cdrsaved:
+                if attempt > MAXRETRY-2:
+                    logger.info(f"module=liberator, space=cdrasync, action=savehandler, state=clear, uuid={self.uuid}, attempted={attempt}")
+                break
+            else:
+                if cdrdrain.active: break
+                backoff = reebackoff(waiting, attempt)
+                if attempt >= MAXRETRY-2:
+                    logger.warning(f"module=liberator, space=cdrasync, action=savehandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
+                # a drain cut the backoff short, the cdr get one last attempt then it is spooled
+                try:
+                    await asyncio.wait_for(self.engine.draining.wait(), backoff)
+                except asyncio.TimeoutError:
+                    pass
+        return cdrsaved
+
+    async def afinalize(self, cdrsaved):
+        self.finalizing = True
+        if (not cdrsaved) or DISKCDR_ENABLE:
+            # the shared file writer thread call release once the line is committed
+            self.loop = asyncio.get_running_loop()
+            self.committed = self.loop.create_future()
+            await asyncio.to_thread(self.engine.filewriter.submit, self, cdrsaved)
+            spooled = await self.committed
+        else:
+            spooled = None
+        if spooled is None:
+            spooled = self.spoolable(cdrsaved)
+            if spooled: await asyncio.to_thread(self.spool.append, [self.cdrdata])
+        cdrdrain.count(cdrsaved, spooled)
+        if CDRKPI_WINDOW and isinstance(self.cdrdata, CDRRecord): cdrkpi.add(self.details, self.cdrdata)
+
+        rcleaned = False; waiting = 5; attempt = 0
+        while attempt < MAXRETRY and not self.engine.stop:
+            rcleaned = await self.arclean()
+            attempt += 1
+            if rcleaned:
+                break
+            else:
+                backoff = reebackoff(waiting, attempt)
+                if attempt >= MAXRETRY-2:
+                    logger.warning(f"module=liberator, space=cdrasync, action=rdbhandler, state=stuck, uuid={self.uuid}, attempted={attempt}, backoff={backoff}")
+                await asyncio.sleep(backoff)
+
+    def release(self, cdrsaved, spooled=None):
+        # called from the file writer thread, resume afinalize on the event loop
+        self.loop.call_soon_threadsafe(self.commit, spooled)
+
+    def commit(self, spooled):
+        # task may have been cancelled by a drain meanwhile
+        if not self.committed.done():
+            self.committed.set_result(spooled)
+
+    async def ahttpsave(self):
+        if cdrdedup.seen(self.uuid):
+            logger.info(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=httpsave, state=duplicated, uuid={self.uuid}")
+            return True
+        signature = {'X-Signature': f'{_APPLICATION} {_SWVERSION}', 'Idempotency-Key': self.uuid}
+        candidates = endpointorder()
+        content = CDRPayload([self.cdrdata])
+        # endpoint that changed encoding on a 415, it is posted again once
+        renegotiated = set()
+        status = 0; attempt = 0; accepted = False
+        deadline = time.time() + HTTPCDR_READ_TIMEOUT
+        while candidates and not accepted:
+            # slot under the endpoint concurrency limit, waiting on the lock would block the loop so wait for a release instead
+            endpoint = endpointacquire(candidates, 0)
+            if endpoint is None:
+                remaining = deadline - time.time()
+                if remaining <= 0: break
+                # a release between the acquire and the clear set it again once the loop run
+                self.engine.slotreleased.clear()
+                try:
+                    await asyncio.wait_for(self.engine.slotreleased.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            candidates.remove(endpoint)
+            attempt += 1; start = time.time(); outcome = 'failure'
+            try:
+                encoding = endpoint.encoding
+                payload, headers = content.encode(encoding)
+                response = await self.engine.httpclient.post(endpoint.url, headers={**headers, **signature}, content=payload)
+                status = response.status_code
+                if status==200:
+                    outcome = 'success'; accepted = True
+                    shortcdr = {'uuid': self.cdrdata.get('uuid'), 'seshid': self.cdrdata.get('seshid')}
+                    logger.info(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=httpsave, endpoint={endpoint.url}, status={status}, attempt={attempt}, shortcdr={shortcdr}, delay={round(time.time()-start, 3)}")
+                elif status >= 500 or status == 429:
+                    outcome = 'overload'
+                if endpointnegotiate(endpoint, status, response.headers.get('Accept'), encoding) and endpoint.url not in renegotiated:
+                    # tried again at once in the encoding it take, the 415 tell nothing of its health
+                    outcome = 'neutral'
+                    renegotiated.add(endpoint.url)
+                    candidates.insert(0, endpoint)
+            except httpx.TimeoutException as e:
+                outcome = 'overload'
+                logger.warning(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=httpsave, endpoint={endpoint.url}, status={status}, attempt={attempt}, exception={e}")
+            except Exception as e:
+                logger.warning(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=httpsave, endpoint={endpoint.url}, status={status}, attempt={attempt}, exception={e}")
+            finally:
+                endpointreport(endpoint, outcome, time.time()-start)
+        endpointskip(candidates)
+        if accepted:
+            cdrdedup.add([self.uuid])
+        return accepted
+
+    async def arclean(self):
+        try:
+            pipe = self.engine.rdbconn.pipeline()
+            if self.entryid:
+                pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, self.entryid)
+                pipe.xdel(CDRSTREAM, self.entryid)
+            else:
+                pipe.zrem('cdr:inprogress', self.uuid)
+                pipe.delete(f'cdr:detail:{self.uuid}')
+                if CDRQUEUE_RELIABLE: pipe.lrem(CDRPROCESSING, 1, self.uuid)
+            await pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"module=liberator, space=cdrasync, class=AsyncCDRHandler, action=rclean, exception={e}, tracings={traceback.format_exc()}")
+            return False
+
+
+class AsyncCDRMaster(Thread):
+    """ cdr engine running in a single thread with its own event loop, alternative of CDRMaster """
+    def __init__(self):
+        self.stop = False
+        self.rdbconn = None
+        self.rdbsync = None
+        self.httpclient = None
+        self.spool = None
+        self.filewriter = None
+        # cursor of own pending entries reading, None once they are all dispatched
+        self.pending = '0'
+        self.last_claim_time = 0
+        # cursor of the scan for idle entries of other consumers, 0-0 once the whole stream is scanned
+        self.claimcursor = '0-0'
+        self.deadline = 0
+        self.loop = None
+        self.draining = None
+        self.slotreleased = None
+        Thread.__init__(self)
+        self.setName('AsyncCDRMaster')
+
+    def drain(self, timeout=CDR_DRAIN_TIMEOUT):
+        # same as CDRMaster.drain, in-flight tasks are awaited up to deadline
+        self.deadline = time.time() + timeout
+        cdrdrain.active = True
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.draining.set)
+        logger.info(f"module=liberator, space=cdrasync, action=drain, state=started, timeout={timeout}")
+        self.join(timeout + REDIS_TIMEOUT + 5)
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdrasync, action=start_cdr_thread, inflight={CDR_ASYNC_INFLIGHT}")
+        if CDR_SINKS:
+            logger.warning("module=liberator, space=cdrasync, action=start_cdr_thread, note=CDR_SINKS is only supported by thread engine, ignored")
+        replayer = None; backfiller = None
+        try:
+            self.filewriter = CDRFileWriter(DISKCDR_FLUSHINTERVAL, DISKCDR_FLUSHSIZE, DISKCDR_COMPRESSION)
+            self.filewriter.start()
+            rdbconn = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD, decode_responses=True)
+            self.rdbsync = rdbconn
+            if CDR_TRANSPORT == 'stream':
+                streamgroup(rdbconn)
+            elif CDRQUEUE_RELIABLE:
+                cdrrecover(rdbconn)
+            cdrdedup.load(rdbconn)
+            # replay of spooled cdr keep its own thread, it is rate limited and rarely busy
+            if HTTPCDR_ENDPOINTS:
+                self.spool = CDRSpool(CDRSPOOLDIR, CDRSPOOL_SEGMENTSIZE)
+                if CDRSPOOL_REPLAYRATE:
+                    replayer = CDRReplayer(self.spool, CDRSPOOL_REPLAYRATE)
+                    replayer.start()
+            if CDRBACKFILL_INTERVAL:
+                backfiller = CDRBackfill(f'{LOGDIR}/cdr', CDRBACKFILL_INTERVAL, CDRINGEST_BATCHSIZE)
+                backfiller.start()
+            if CDRKPI_WINDOW:
+                cdrkpi.start()
+            if CDRDEDUP_WINDOW:
+                cdrdedup.start()
+            asyncio.run(self.main())
+        except Exception as e:
+            logger.critical(f"module=liberator, space=cdrasync, class=AsyncCDRMaster, action=run, exception={e}, tracings={traceback.format_exc()}")
+        finally:
+            if replayer: replayer.stop = True
+            if backfiller: backfiller.stop = True
+            cdrkpi.stop = True
+            cdrdedup.stop = True
+            if self.filewriter:
+                self.filewriter.stop = True
+                if cdrdrain.active: self.filewriter.join(5)
+
+    async def streamingest(self, batchsize):
+        # same order as CDRStreamMaster: own pending entries, then idle entries of other consumer, then new entries
+        if self.pending:
+            reply = await self.rdbconn.xreadgroup(CDR_STREAM_GROUP, CDR_CONSUMERID, {CDRSTREAM: self.pending}, count=batchsize)
+            history = reply[0][1] if reply else []
+            if history:
+                self.pending = history[-1][0]
+                # reset their idle time, so they are not claimed back while being delivered
+                await self.rdbconn.xclaim(CDRSTREAM, CDR_STREAM_GROUP, CDR_CONSUMERID, 0, [entryid for entryid, fields in history], justid=True)
+                deleted = [entryid for entryid, fields in history if not fields]
+                if deleted: await self.rdbconn.xack(CDRSTREAM, CDR_STREAM_GROUP, *deleted)
+                logger.info(f"module=liberator, space=cdrasync, action=stream_pending, consumer={CDR_CONSUMERID}, entries={len(history)}")
+                return streamentries(history)
+            self.pending = None
+        current_time = time.time()
+        # a scan that stopped at batchsize go on at once from where it was
+        if self.claimcursor != '0-0' or (current_time - self.last_claim_time) > CDR_STREAM_CLAIMIDLE/10:
+            self.last_claim_time = current_time
+            reply = await self.rdbconn.xautoclaim(CDRSTREAM, CDR_STREAM_GROUP, CDR_CONSUMERID, CDR_STREAM_CLAIMIDLE*1000, start_id=self.claimcursor, count=batchsize)
+            self.claimcursor = reply[0]
+            entries = streamentries(reply[1])
+            if entries: return entries
+        reply = await self.rdbconn.xreadgroup(CDR_STREAM_GROUP, CDR_CONSUMERID, {CDRSTREAM: '>'}, count=batchsize, block=REDIS_TIMEOUT*1000)
+        return streamentries(reply[0][1]) if reply else []
+
+    async def ingest(self, batchsize):
+        if CDR_TRANSPORT == 'stream':
+            return await self.streamingest(batchsize)
+        # block for the first uuid, then take the rest of batch without waiting
+        if CDRQUEUE_RELIABLE:
+            uuid = await self.rdbconn.blmove('cdr:queue:new', CDRPROCESSING, REDIS_TIMEOUT, 'LEFT', 'RIGHT')
+            if not uuid: return []
+            uuids = [uuid]
+            if batchsize > 1:
+                pipe = self.rdbconn.pipeline(transaction=False)
+                for _ in range(batchsize-1):
+                    pipe.lmove('cdr:queue:new', CDRPROCESSING, 'LEFT', 'RIGHT')
+                uuids += [uuid for uuid in await pipe.execute() if uuid]
+        else:
+            reply = await self.rdbconn.blpop('cdr:queue:new', REDIS_TIMEOUT)
+            if not reply: return []
+            uuids = [reply[1]]
+            if batchsize > 1:
+                pipe = self.rdbconn.pipeline(transaction=True)
+                pipe.lrange('cdr:queue:new', 0, batchsize-2)
+                pipe.ltrim('cdr:queue:new', batchsize-1, -1)
+                uuids += (await pipe.execute())[0]
+        score = int(time.time())
+        pipe = self.rdbconn.pipeline(transaction=False)
+        pipe.zadd('cdr:inprogress', {uuid: score for uuid in uuids})
+        pipe.mget([f'cdr:detail:{uuid}' for uuid in uuids])
+        _, detail_values = await pipe.execute()
+        return [(uuid, detail_value, None) for uuid, detail_value in zip(uuids, detail_values)]
+
+    async def discard(self, lostentries):
+        pipe = self.rdbconn.pipeline()
+        if CDR_TRANSPORT == 'stream':
+            entryids = [entryid for uuid, entryid in lostentries]
+            pipe.xack(CDRSTREAM, CDR_STREAM_GROUP, *entryids)
+            pipe.xdel(CDRSTREAM, *entryids)
+        else:
+            pipe.zrem('cdr:inprogress', *[uuid for uuid, entryid in lostentries])
+            if CDRQUEUE_RELIABLE:
+                for uuid, entryid in lostentries: pipe.lrem(CDRPROCESSING, 1, uuid)
+        await pipe.execute()
+
+    async def main(self):
+        self.rdbconn = aioredis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD,
+                                            decode_responses=True)
+        poolsize = HTTPCDR_POOLSIZE or CDR_ASYNC_INFLIGHT
+        self.httpclient = httpx.AsyncClient(limits=httpx.Limits(max_connections=poolsize, max_keepalive_connections=poolsize),
+                                            timeout=httpx.Timeout(HTTPCDR_READ_TIMEOUT, connect=HTTPCDR_CONNECT_TIMEOUT))
+        inflight = asyncio.Semaphore(CDR_ASYNC_INFLIGHT)
+        # task: handler
+        tasks = {}
+        self.draining = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        # set when a handler may take an endpoint slot, by whatever thread released it
+        self.slotreleased = asyncio.Event()
+        endpointwatch(lambda: self.loop.call_soon_threadsafe(self.slotreleased.set))
+
+        async def handle(handler):
+            try:
+                await handler.arun()
+            finally:
+                inflight.release()
+
+        last_cleanup_time = 0
+        while not self.stop and not cdrdrain.active:
+            # do not take more cdr from redis until an in-flight delivery is done
+            try:
+                await asyncio.wait_for(inflight.acquire(), 1)
+            except asyncio.TimeoutError:
+                continue
+            # reserve as many slot as free, up to ingest batch size
+            permits = 1
+            while permits < CDRINGEST_BATCHSIZE and not inflight.locked():
+                await inflight.acquire()
+                permits += 1
+            try:
+                current_time = time.time()
+                if CDR_TRANSPORT == 'list' and (current_time - last_cleanup_time) > CDRTTL:
+                    cutoff_time = int(current_time) - CDRTTL
+                    # rare and bounded, the sweep run on a blocking connection off the loop
+                    recovered, lost = await asyncio.to_thread(cdrsweep, self.rdbsync, cutoff_time)
+                    if recovered or lost:
+                        logger.info(f"module=liberator, space=cdrasync, action=periodic_cleanup, orphans_recovered={recovered}, orphans_lost={lost}")
+                    last_cleanup_time = current_time
+                lostentries = []
+                for uuid, detail_value, entryid in await self.ingest(permits):
+                    if detail_value:
+                        handler = AsyncCDRHandler(uuid, jsoncodec.loads(detail_value), self, entryid)
+                        task = asyncio.create_task(handle(handler))
+                        tasks[task] = handler
+                        task.add_done_callback(lambda task: tasks.pop(task, None))
+                        permits -= 1
+                    else:
+                        logger.warning(f"module=liberator, space=cdrasync, action=cdrmaster, state=detail_expired, uuid={uuid}, note=CDR_LOST")
+                        lostentries.append((uuid, entryid))
+                if lostentries:
+                    await self.discard(lostentries)
+            except redis.RedisError as e:
+                await asyncio.sleep(5)
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdrasync, class=AsyncCDRMaster, action=main, exception={e}, tracings={traceback.format_exc()}")
+                await asyncio.sleep(2)
+            finally:
+                # give back the slots that were not used by a handler
+                for _ in range(permits): inflight.release()
+
+        if cdrdrain.active:
+            unfinished = []
+            if tasks:
+                done, unfinished = await asyncio.wait(list(tasks), timeout=max(self.deadline - time.time(), 0))
+            # cdr not delivered by deadline are handed back to redis, the ones being finalized are let finish
+            delivering = [task for task in unfinished if not tasks[task].finalizing]
+            entries = [(tasks[task].uuid, tasks[task].entryid) for task in delivering]
+            for task in delivering: task.cancel()
+            handedback = 0
+            if entries:
+                try:
+                    handedback = await asyncio.to_thread(cdrrequeue, self.rdbsync, entries)
+                except Exception as e:
+                    logger.error(f"module=liberator, space=cdrasync, class=AsyncCDRMaster, action=drain, state=handback, size={len(entries)}, exception={e}")
+            logger.info(f"module=liberator, space=cdrasync, action=drain, state=done, completed={cdrdrain.completed}, spooled={cdrdrain.spooled}, filed={cdrdrain.filed}, "
+                        f"unfinished={len(entries)}, handedback={handedback}, finalizing={len(unfinished)-len(delivering)}")
+            if tasks:
+                await asyncio.wait(list(tasks), timeout=5)
+        elif tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await self.httpclient.aclose()
+        await self.rdbconn.aclose()
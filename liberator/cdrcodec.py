@@ -0,0 +1,98 @@
+#
+# liberator:cdrcodec.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+
+import hashlib
+import jsoncodec
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# media type of the cdr encodings, an endpoint that take many get the first one
+MEDIATYPES = {
+    'lp': 'application/vnd.libresbc.cdr+lp',
+    'msgpack': 'application/msgpack',
+    'json': 'application/json',
+}
+_ALIASES = {'application/x-msgpack': 'msgpack'}
+_ENCODINGS = {mediatype: encoding for encoding, mediatype in MEDIATYPES.items()}
+_ENCODINGS.update(_ALIASES)
+
+
+def negotiate(accept):
+    # encoding to use for an endpoint that answer with Accept header, eg: application/msgpack, application/json
+    mediatypes = set(mediatype.split(';')[0].strip().lower() for mediatype in accept.split(','))
+    accepted = set(_ENCODINGS.get(mediatype) for mediatype in mediatypes)
+    for encoding in MEDIATYPES:
+        if encoding in accepted and (encoding != 'msgpack' or msgpack):
+            return encoding
+    return 'json'
+
+
+def uvarint(number):
+    # unsigned little endian base 128
+    octets = bytearray()
+    while number > 0x7f:
+        octets.append((number & 0x7f) | 0x80)
+        number >>= 7
+    octets.append(number)
+    return bytes(octets)
+
+
+def lpschema(fields):
+    # collector check the field order it decode with against this id
+    return hashlib.sha1(','.join(fields).encode()).hexdigest()[:8]
+
+
+def lprecord(record):
+    # every field in record order, prefixed by its length + 1 and 0 for null, the record is prefixed by its length
+    chunks = []
+    for value in record:
+        if value is None:
+            chunks.append(b'\x00')
+            continue
+        if value is True or value is False: value = 'true' if value else 'false'
+        value = str(value).encode()
+        chunks.append(uvarint(len(value) + 1))
+        chunks.append(value)
+    body = b''.join(chunks)
+    return uvarint(len(body)) + body
+
+
+class CDRPayload:
+    """ cdr of a request, encoded once per encoding the endpoints take """
+    def __init__(self, cdrs, batchformat=None, jsonline=None):
+        # cdrs: refined records, a single one is posted as document and many as batch
+        self.cdrs = cdrs
+        self.batchformat = batchformat
+        self.encoded = {}
+        # spooled cdr is posted as it was written
+        if jsonline is not None:
+            self.encoded['json'] = jsonline, {'Content-Type': MEDIATYPES['json']}
+
+    def encode(self, encoding):
+        if encoding not in self.encoded:
+            self.encoded[encoding] = self.serialize(encoding)
+        return self.encoded[encoding]
+
+    def serialize(self, encoding):
+        if self.cdrs is None:
+            self.cdrs = [jsoncodec.loads(self.encoded['json'][0])]
+        # the schema only fit refined leg, joined session and spooled cdr take the next encoding
+        if encoding == 'lp' and all(hasattr(cdr, '_fields') for cdr in self.cdrs):
+            return b''.join(lprecord(cdr) for cdr in self.cdrs), {'Content-Type': MEDIATYPES['lp'], 'X-CDR-Schema': lpschema(self.cdrs[0]._fields)}
+        documents = [cdr.asdict() if hasattr(cdr, 'asdict') else cdr for cdr in self.cdrs]
+        if encoding in ('lp', 'msgpack') and msgpack:
+            return msgpack.packb(documents if self.batchformat else documents[0]), {'Content-Type': MEDIATYPES['msgpack']}
+        if not self.batchformat:
+            return jsoncodec.dumps(documents[0]), {'Content-Type': MEDIATYPES['json']}
+        if self.batchformat == 'ndjson':
+            return b''.join(jsoncodec.dumps(document) + b'\n' for document in documents), {'Content-Type': 'application/x-ndjson'}
+        return jsoncodec.dumps(documents), {'Content-Type': MEDIATYPES['json']}
@@ -0,0 +1,242 @@
+#
+# liberator:cdrprocess.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+
+import os
+import time
+import signal
+import traceback
+import zlib
+import multiprocessing
+from threading import Thread
+from queue import Empty, Full
+
+import redis
+
+from configuration import (CDRTTL, REDIS_TIMEOUT, CDRWORKER_QUEUESIZE, CDRINGEST_BATCHSIZE, CDRQUEUE_RELIABLE, CDR_DRAIN_TIMEOUT,
+                           HTTPCDR_ENDPOINTS, CDRSPOOL_SEGMENTSIZE, CDRSPOOL_REPLAYRATE, CDRBACKFILL_INTERVAL, CDRDEDUP_WINDOW, LOGDIR)
+from utilities import logger
+from cdr import (rdbconn, CDRRETRY, CDRSPOOLDIR, CDRMaster, CDRSpool, CDRReplayer, CDRBackfill,
+                 cdrtake, cdrsweep, cdrrecover, cdrrequeue, cdrdrain, cdrdedup)
+
+
+def cdrshard(uuid, shards):
+    # stable over restart and between processes, unlike hash()
+    return zlib.crc32(uuid.encode()) % shards
+
+
+class CDRShardMaster(CDRMaster):
+    """ cdr engine of a worker process, it take the uuid sharded to it by the parent instead of reading the queue """
+    def __init__(self, shard, shards, uuidqueue):
+        CDRMaster.__init__(self)
+        self.setName(f'CDRShardMaster-{shard}')
+        self.shard = shard
+        self.uuidqueue = uuidqueue
+        # each process spool to its own directory, the segment numbering is not shared
+        self.spooldir = f'{CDRSPOOLDIR}/{shard}'
+        # and write its own cdr file, the file writer stay the single writer of a file
+        self.filepart = f'.{shard}'
+        self.backfilling = False
+        self.owned = lambda uuid: cdrshard(uuid, shards) == shard
+
+    def prepare(self, rdbconn):
+        pass
+
+    def maintain(self, rdbconn, current_time):
+        pass
+
+    def ingest(self, rdbconn, batchsize):
+        try:
+            uuids = self.uuidqueue.get(timeout=1)
+        except Empty:
+            return []
+        # a deadline instead of uuids: the parent is shutting down
+        if isinstance(uuids, float):
+            self.deadline = uuids
+            cdrdrain.active = True
+            logger.info(f"module=liberator, space=cdr, action=drain, state=started, shard={self.shard}, inhand={cdrdrain.inhand}")
+            return []
+        # the parent already marked them in progress
+        detail_values = rdbconn.mget([f'cdr:detail:{uuid}' for uuid in uuids])
+        return [(uuid, detail_value, None) for uuid, detail_value in zip(uuids, detail_values)]
+
+
+def shardmain(shard, shards, uuidqueue):
+    # entry point of worker process, the parent handle the interrupt and tell the worker when to drain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    master = CDRShardMaster(shard, shards, uuidqueue)
+    def terminate(signum, frame):
+        # once draining, the parent terminate a stuck worker before killing it, that must not drain again
+        if cdrdrain.active: return
+        master.drain(CDR_DRAIN_TIMEOUT)
+    signal.signal(signal.SIGTERM, terminate)
+    master.start()
+    while master.is_alive():
+        master.join(1)
+
+
+class CDRProcessMaster(Thread):
+    """ take cdr uuid from redis queue and shard them by hash to worker processes, each with its own redis pool and http sessions """
+    def __init__(self, shards):
+        self.stop = False
+        self.shards = shards
+        # fork is not safe with the threads and connection pools of this process
+        self.context = multiprocessing.get_context('spawn')
+        # queue item is a batch of uuid
+        self.uuidqueues = [self.context.Queue(maxsize=max(1, CDRWORKER_QUEUESIZE // CDRINGEST_BATCHSIZE)) for _ in range(shards)]
+        self.processes = [None]*shards
+        self.replayers = []
+        self.backfiller = None
+        self.last_cleanup_time = 0
+        self.deadline = 0
+        self.notified = False
+        Thread.__init__(self)
+        self.setName('CDRProcessMaster')
+
+    def spawn(self, shard):
+        process = self.context.Process(target=shardmain, args=(shard, self.shards, self.uuidqueues[shard]), name=f'CDRShard-{shard}')
+        process.start()
+        self.processes[shard] = process
+        logger.info(f"module=liberator, space=cdr, action=spawn_worker_process, shard={shard}, pid={process.pid}")
+
+    def watch(self):
+        # a dead worker is replaced, uuid in its queue wait for the new one
+        for shard, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.error(f"module=liberator, space=cdr, action=worker_process_exited, shard={shard}, pid={process.pid}, exitcode={process.exitcode}")
+                self.spawn(shard)
+
+    def send(self, shard, uuids):
+        # block while the worker is saturated, that is the backpressure to redis queue
+        while not self.stop and not cdrdrain.active:
+            try:
+                self.uuidqueues[shard].put(uuids, timeout=1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def drain(self, timeout=CDR_DRAIN_TIMEOUT):
+        # called on shutdown: stop ingesting, worker processes deliver or spool cdr in hand, then stop
+        self.deadline = time.time() + timeout
+        cdrdrain.active = True
+        logger.info(f"module=liberator, space=cdr, action=drain, state=started, processes={self.shards}, timeout={timeout}")
+        # worker start at once, while ingest may be blocked on redis for REDIS_TIMEOUT
+        self.notify()
+        self.join(timeout + REDIS_TIMEOUT + 10)
+
+    def handback(self):
+        # uuid that no worker took are handed back to redis
+        uuids = []
+        for uuidqueue in self.uuidqueues:
+            while True:
+                try:
+                    item = uuidqueue.get(timeout=0.1)
+                    if isinstance(item, list): uuids += item
+                except Empty:
+                    break
+            uuidqueue.cancel_join_thread()
+        handedback = 0
+        if uuids:
+            try:
+                handedback = cdrrequeue(rdbconn, [(uuid, None) for uuid in uuids])
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRProcessMaster, action=drain, state=handback, size={len(uuids)}, exception={e}")
+        return len(uuids), handedback
+
+    def notify(self):
+        # the deadline follow the uuid already sent, uuid sent after it are handed back
+        self.notified = True
+        for shard, uuidqueue in enumerate(self.uuidqueues):
+            try:
+                uuidqueue.put(float(self.deadline), timeout=1)
+            except Full:
+                logger.warning(f"module=liberator, space=cdr, action=drain, state=saturated, shard={shard}")
+
+    def settle(self):
+        if not self.notified:
+            self.notify()
+        for process in self.processes:
+            process.join(max(self.deadline - time.time(), 0) + REDIS_TIMEOUT + 5)
+        for process in self.processes:
+            # its unfinished cdr stay in progress, they are recovered by the orphan sweep
+            if process.is_alive():
+                logger.warning(f"module=liberator, space=cdr, action=drain, state=terminate, pid={process.pid}")
+                process.terminate()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                logger.warning(f"module=liberator, space=cdr, action=drain, state=kill, pid={process.pid}")
+                process.kill()
+                process.join(1)
+        return self.handback()
+
+    def run(self):
+        logger.info(f"module=liberator, space=cdr, action=start_cdr_thread, processes={self.shards}, queuesize={CDRWORKER_QUEUESIZE}")
+        if HTTPCDR_ENDPOINTS and CDRSPOOL_REPLAYRATE:
+            # spool left by in-process engine, or by worker that no longer exist after the number of processes was reduced
+            os.makedirs(CDRSPOOLDIR, exist_ok=True)
+            spooldirs = [CDRSPOOLDIR] + [f'{CDRSPOOLDIR}/{name}' for name in os.listdir(CDRSPOOLDIR) if name.isdigit() and int(name) >= self.shards]
+            for spooldir in spooldirs:
+                replayer = CDRReplayer(CDRSpool(spooldir, CDRSPOOL_SEGMENTSIZE), CDRSPOOL_REPLAYRATE)
+                replayer.start()
+                self.replayers.append(replayer)
+        if CDRBACKFILL_INTERVAL:
+            self.backfiller = CDRBackfill(f'{LOGDIR}/cdr', CDRBACKFILL_INTERVAL, CDRINGEST_BATCHSIZE)
+            self.backfiller.start()
+        # replayed and backfilled cdr are acknowledged in this process
+        if CDRDEDUP_WINDOW:
+            cdrdedup.start()
+
+        prepared = False
+        while not self.stop and not cdrdrain.active:
+            try:
+                if not prepared:
+                    # recover before any worker start, they reload their own retry schedule
+                    if CDRQUEUE_RELIABLE:
+                        cdrrecover(rdbconn)
+                        rdbconn.delete(CDRRETRY)
+                    for shard in range(self.shards):
+                        self.spawn(shard)
+                    prepared = True
+                self.watch()
+                current_time = time.time()
+                if (current_time - self.last_cleanup_time) > CDRTTL:
+                    recovered, lost = cdrsweep(rdbconn, int(current_time) - CDRTTL)
+                    if recovered or lost:
+                        logger.info(f"module=liberator, space=cdr, action=periodic_cleanup, orphans_recovered={recovered}, orphans_lost={lost}")
+                    self.last_cleanup_time = current_time
+                uuids = cdrtake(rdbconn, CDRINGEST_BATCHSIZE)
+                if not uuids:
+                    continue
+                score = int(time.time())
+                rdbconn.zadd('cdr:inprogress', {uuid: score for uuid in uuids})
+                shards = {}
+                for uuid in uuids:
+                    shards.setdefault(cdrshard(uuid, self.shards), []).append(uuid)
+                for shard, sharded in shards.items():
+                    if not self.send(shard, sharded):
+                        # shutdown while the worker is saturated
+                        cdrrequeue(rdbconn, [(uuid, None) for uuid in sharded])
+            except redis.RedisError as e:
+                # wait and try again
+                time.sleep(5)
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdr, class=CDRProcessMaster, action=run, exception={e}, tracings={traceback.format_exc()}")
+                time.sleep(2)
+            finally: pass
+
+        if prepared:
+            left, handedback = self.settle()
+        for replayer in self.replayers:
+            replayer.stop = True
+        if self.backfiller:
+            self.backfiller.stop = True
+        cdrdedup.stop = True
+        if cdrdrain.active and prepared:
+            logger.info(f"module=liberator, space=cdr, action=drain, state=done, processes={self.shards}, inqueue={left}, handedback={handedback}")
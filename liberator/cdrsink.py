@@ -0,0 +1,239 @@
+#
+# liberator:cdrsink.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+
+import time
+import traceback
+import socket
+import sqlite3
+import heapq
+from itertools import count
+from abc import ABC, abstractmethod
+from threading import Thread, Semaphore, Lock
+from queue import Queue, Full
+
+from configuration import (HTTPCDR_BATCHSIZE, HTTPCDR_BATCHWAIT, HTTPCDR_BATCHFORMAT, CDRWORKER_POOLSIZE, CDRWORKER_QUEUESIZE,
+                           CDR_SQLITE_PATH, CDR_SYSLOG_ADDRESS)
+from utilities import logger
+from cdr import MAXRETRY, CDRKEYS, reebackoff, qcollect, httpbatch, cdrdrain
+import jsoncodec
+
+
+class CDRSink(ABC):
+    """ cdr destination with its own bounded queue, worker threads and retry policy """
+    name = None
+
+    def __init__(self, mandatory=False, concurrency=1, retry=MAXRETRY, queuesize=CDRWORKER_QUEUESIZE, batchsize=1, batchwait=0):
+        self.stop = False
+        self.mandatory = mandatory
+        self.concurrency = concurrency
+        self.retry = retry
+        self.batchsize = batchsize
+        self.batchwait = batchwait/1000
+        self.handlers = Queue(maxsize=queuesize)
+        # failed batches waiting for their backoff: (due, sequence, attempt, handlers)
+        self.delayed = []
+        self.sequence = count()
+        self.lock = Lock()
+        # cdr the optional sink did not take as its queue was full, since the last report
+        self.dropped = 0
+
+    def start(self):
+        logger.info(f"module=liberator, space=cdrsink, action=start_sink_threads, sink={self.name}, mandatory={self.mandatory}, concurrency={self.concurrency}, retry={self.retry}, batchsize={self.batchsize}")
+        for index in range(self.concurrency):
+            thread = Thread(target=self.consume, name=f'CDRSink-{self.name}-{index}')
+            thread.start()
+
+    def submit(self, handler):
+        # only a mandatory sink hold the fanout back, an optional one that lag behind drop the cdr
+        if not self.mandatory:
+            try:
+                self.handlers.put_nowait(handler)
+            except Full:
+                self.dropped += 1
+                handler.acknowledge(self, False)
+            return
+        while not self.stop:
+            try:
+                self.handlers.put(handler, timeout=1)
+                return
+            except Full:
+                continue
+        handler.acknowledge(self, False)
+
+    def stats(self):
+        dropped, self.dropped = self.dropped, 0
+        return {'pending': self.handlers.qsize(), 'dropped': dropped}
+
+    @abstractmethod
+    def write(self, handlers):
+        # deliver the handlers cdr, return the ones that failed
+        pass
+
+    def postpone(self, handlers, attempt, backoff):
+        with self.lock:
+            heapq.heappush(self.delayed, (time.time() + backoff, next(self.sequence), attempt, handlers))
+
+    def due(self):
+        # failed batch whose backoff is over, any of them at once when stopping or draining
+        with self.lock:
+            if self.delayed and (self.delayed[0][0] <= time.time() or self.stop or cdrdrain.active):
+                due, sequence, attempt, handlers = heapq.heappop(self.delayed)
+                return handlers, attempt
+        return [], 0
+
+    def consume(self):
+        # single attempt per batch, a failed one wait in the heap instead of holding the thread
+        while True:
+            batch, attempt = self.due()
+            if not batch:
+                batch = qcollect(self.handlers, self.batchsize, self.batchwait)
+            if not batch:
+                if self.stop and not self.delayed: break
+                continue
+            pending = batch
+            try:
+                pending = self.write(batch)
+            except Exception as e:
+                logger.error(f"module=liberator, space=cdrsink, action=write, sink={self.name}, size={len(batch)}, exception={e}, tracings={traceback.format_exc()}")
+            attempt += 1
+            failures = set(id(handler) for handler in pending)
+            if pending and attempt < self.retry and not self.stop and not cdrdrain.active:
+                backoff = reebackoff(5, attempt)
+                logger.warning(f"module=liberator, space=cdrsink, action=write, sink={self.name}, state=stuck, size={len(pending)}, attempted={attempt}, backoff={backoff}")
+                self.postpone(pending, attempt, backoff)
+                batch = [handler for handler in batch if id(handler) not in failures]
+                failures = set()
+            for handler in batch:
+                try:
+                    handler.acknowledge(self, id(handler) not in failures)
+                except Exception as e:
+                    logger.error(f"module=liberator, space=cdrsink, action=acknowledge, sink={self.name}, uuid={handler.uuid}, exception={e}, tracings={traceback.format_exc()}")
+
+
+class HTTPSink(CDRSink):
+    name = 'http'
+
+    def write(self, handlers):
+        if self.batchsize == 1:
+            return [handler for handler in handlers if not handler.httpsave()]
+        return httpbatch(handlers, HTTPCDR_BATCHFORMAT, 0)
+
+
+class FileSink(CDRSink):
+    """ raw cdr to the cdr file, through the shared group-commit file writer """
+    name = 'file'
+
+    def __init__(self, filewriter, **kwargs):
+        CDRSink.__init__(self, **kwargs)
+        self.filewriter = filewriter
+
+    def write(self, handlers):
+        # a joined session is written as its raw legs
+        done = Semaphore(0); failures = []
+        def committed(handler):
+            def callback(success):
+                if not success and handler not in failures: failures.append(handler)
+                done.release()
+            return callback
+        legs = [(leg, handler) for handler in handlers for leg in handler.legs()]
+        for leg, handler in legs:
+            self.filewriter.submit(leg, None, committed(handler))
+        for leg in legs:
+            done.acquire()
+        return failures
+
+
+class SQLiteSink(CDRSink):
+    """ refined cdr to a local sqlite database, one row per uuid """
+    name = 'sqlite'
+
+    def __init__(self, path, **kwargs):
+        # sqlite has a single writer
+        kwargs['concurrency'] = 1
+        CDRSink.__init__(self, **kwargs)
+        self.path = path
+        self.dbconn = None
+        self.statement = f"INSERT OR REPLACE INTO cdr ({', '.join(CDRKEYS)}) VALUES ({', '.join('?' for _ in CDRKEYS)})"
+
+    def connect(self):
+        dbconn = sqlite3.connect(self.path)
+        dbconn.execute('PRAGMA journal_mode=WAL')
+        dbconn.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(f'{field} TEXT' for field in CDRKEYS if field != 'uuid')
+        dbconn.execute(f'CREATE TABLE IF NOT EXISTS cdr (uuid TEXT PRIMARY KEY, {columns})')
+        dbconn.execute('CREATE INDEX IF NOT EXISTS cdr_seshid ON cdr (seshid)')
+        dbconn.commit()
+        return dbconn
+
+    def write(self, handlers):
+        # one row per leg of joined session, cdr that failed the refinement has no row
+        rows = [tuple(leg.cdrdata) for handler in handlers for leg in handler.legs() if leg.cdrdata]
+        try:
+            if self.dbconn is None:
+                self.dbconn = self.connect()
+            with self.dbconn:
+                self.dbconn.executemany(self.statement, rows)
+            return []
+        except Exception:
+            if self.dbconn: self.dbconn.close()
+            self.dbconn = None
+            raise
+
+
+class SyslogSink(CDRSink):
+    """ refined cdr as json message to syslog, over unix socket or udp """
+    name = 'syslog'
+    # facility local0, severity informational
+    PRIORITY = 16*8 + 6
+
+    def __init__(self, address, **kwargs):
+        CDRSink.__init__(self, **kwargs)
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            self.address, self.family = (host, int(port)), socket.AF_INET
+        else:
+            self.address, self.family = address, socket.AF_UNIX
+
+    def write(self, handlers):
+        failures = []
+        sock = socket.socket(self.family, socket.SOCK_DGRAM)
+        try:
+            for handler in handlers:
+                message = f'<{self.PRIORITY}>libresbc-cdr: '.encode() + jsoncodec.dumps(handler.cdrdata.asdict())
+                try:
+                    sock.sendto(message, self.address)
+                except OSError as e:
+                    logger.warning(f"module=liberator, space=cdrsink, action=write, sink={self.name}, uuid={handler.uuid}, exception={e}")
+                    failures.append(handler)
+        finally:
+            sock.close()
+        return failures
+
+
+def cdrsinks(sinkspecs, filewriter):
+    # build sinks from CDR_SINKS configuration
+    sinks = []
+    for spec in sinkspecs:
+        options = {key: value for key, value in spec.items() if key != 'name'}
+        if spec['name'] == 'http':
+            options.setdefault('concurrency', CDRWORKER_POOLSIZE)
+            options.setdefault('batchsize', HTTPCDR_BATCHSIZE)
+            sinks.append(HTTPSink(batchwait=HTTPCDR_BATCHWAIT, **options))
+        elif spec['name'] == 'file':
+            # each thread wait for the group commit of its batch
+            options.setdefault('concurrency', 4)
+            options.setdefault('batchsize', 500)
+            sinks.append(FileSink(filewriter, batchwait=50, **options))
+        elif spec['name'] == 'sqlite':
+            options.setdefault('batchsize', 500)
+            sinks.append(SQLiteSink(CDR_SQLITE_PATH, batchwait=100, **options))
+        elif spec['name'] == 'syslog':
+            options.setdefault('batchsize', 100)
+            sinks.append(SyslogSink(CDR_SYSLOG_ADDRESS, batchwait=20, **options))
+    return sinks
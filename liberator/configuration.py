@@ -7,6 +7,7 @@
 # All Rights Reserved.
 #
 import os
+import socket
 #-----------------------------------------------------------------------------------------------------
 #      GLOBAL CONFIGURATION FILES
 #-----------------------------------------------------------------------------------------------------
@@ -135,6 +136,87 @@ CRC_PGSQL_PASSWORD = os.getenv('CRC_PGSQL_PASSWORD')
 HTTPCDR_ENDPOINTS = os.getenv('HTTPCDR_ENDPOINTS')
 if HTTPCDR_ENDPOINTS:
     HTTPCDR_ENDPOINTS = HTTPCDR_ENDPOINTS.split(',')
+
+# keep-alive connection per endpoint, bounded by HTTPCDR_POOLSIZE (default to the number of cdr worker)
+_HTTPCDR_POOLSIZE = os.getenv('HTTPCDR_POOLSIZE')
+HTTPCDR_POOLSIZE = None
+if _HTTPCDR_POOLSIZE and _HTTPCDR_POOLSIZE.isdigit() and int(_HTTPCDR_POOLSIZE) > 0:
+    HTTPCDR_POOLSIZE = int(_HTTPCDR_POOLSIZE)
+
+# timeout in second, decimal value is allowed eg: 0.5
+_HTTPCDR_CONNECT_TIMEOUT = os.getenv('HTTPCDR_CONNECT_TIMEOUT')
+HTTPCDR_CONNECT_TIMEOUT = 3
+if _HTTPCDR_CONNECT_TIMEOUT and _HTTPCDR_CONNECT_TIMEOUT.replace('.', '', 1).isdigit():
+    HTTPCDR_CONNECT_TIMEOUT = float(_HTTPCDR_CONNECT_TIMEOUT)
+
+_HTTPCDR_READ_TIMEOUT = os.getenv('HTTPCDR_READ_TIMEOUT')
+HTTPCDR_READ_TIMEOUT = 10
+if _HTTPCDR_READ_TIMEOUT and _HTTPCDR_READ_TIMEOUT.replace('.', '', 1).isdigit():
+    HTTPCDR_READ_TIMEOUT = float(_HTTPCDR_READ_TIMEOUT)
+
+# circuit breaker: endpoint is skipped after HTTPCDR_BREAKER_THRESHOLD consecutive failures,
+# then probed by a single request every HTTPCDR_BREAKER_COOLDOWN second until it succeed
+_HTTPCDR_BREAKER_THRESHOLD = os.getenv('HTTPCDR_BREAKER_THRESHOLD')
+HTTPCDR_BREAKER_THRESHOLD = 5
+if _HTTPCDR_BREAKER_THRESHOLD and _HTTPCDR_BREAKER_THRESHOLD.isdigit() and int(_HTTPCDR_BREAKER_THRESHOLD) > 0:
+    HTTPCDR_BREAKER_THRESHOLD = int(_HTTPCDR_BREAKER_THRESHOLD)
+
+_HTTPCDR_BREAKER_COOLDOWN = os.getenv('HTTPCDR_BREAKER_COOLDOWN')
+HTTPCDR_BREAKER_COOLDOWN = 30
+if _HTTPCDR_BREAKER_COOLDOWN and _HTTPCDR_BREAKER_COOLDOWN.isdigit():
+    HTTPCDR_BREAKER_COOLDOWN = int(_HTTPCDR_BREAKER_COOLDOWN)
+
+# adaptive concurrency per endpoint: in-flight request limit grows while latency stay flat and is halved on timeout, 5xx
+# max default to the http pool size
+_HTTPCDR_CONCURRENCY_MIN = os.getenv('HTTPCDR_CONCURRENCY_MIN')
+HTTPCDR_CONCURRENCY_MIN = 1
+if _HTTPCDR_CONCURRENCY_MIN and _HTTPCDR_CONCURRENCY_MIN.isdigit() and int(_HTTPCDR_CONCURRENCY_MIN) > 0:
+    HTTPCDR_CONCURRENCY_MIN = int(_HTTPCDR_CONCURRENCY_MIN)
+
+_HTTPCDR_CONCURRENCY_MAX = os.getenv('HTTPCDR_CONCURRENCY_MAX')
+HTTPCDR_CONCURRENCY_MAX = None
+if _HTTPCDR_CONCURRENCY_MAX and _HTTPCDR_CONCURRENCY_MAX.isdigit() and int(_HTTPCDR_CONCURRENCY_MAX) > 0:
+    HTTPCDR_CONCURRENCY_MAX = int(_HTTPCDR_CONCURRENCY_MAX)
+
+# batching mode: deliver up to HTTPCDR_BATCHSIZE cdr per request, waiting at most HTTPCDR_BATCHWAIT millisecond
+_HTTPCDR_BATCHSIZE = os.getenv('HTTPCDR_BATCHSIZE')
+HTTPCDR_BATCHSIZE = 1
+if _HTTPCDR_BATCHSIZE and _HTTPCDR_BATCHSIZE.isdigit() and int(_HTTPCDR_BATCHSIZE) > 0:
+    HTTPCDR_BATCHSIZE = int(_HTTPCDR_BATCHSIZE)
+
+_HTTPCDR_BATCHWAIT = os.getenv('HTTPCDR_BATCHWAIT')
+HTTPCDR_BATCHWAIT = 200
+if _HTTPCDR_BATCHWAIT and _HTTPCDR_BATCHWAIT.isdigit():
+    HTTPCDR_BATCHWAIT = int(_HTTPCDR_BATCHWAIT)
+
+# request body of a batch: json (array) or ndjson (one cdr per line)
+HTTPCDR_BATCHFORMAT = 'json'
+_HTTPCDR_BATCHFORMAT = os.getenv('HTTPCDR_BATCHFORMAT')
+if _HTTPCDR_BATCHFORMAT and _HTTPCDR_BATCHFORMAT.lower() in ['json', 'ndjson']:
+    HTTPCDR_BATCHFORMAT = _HTTPCDR_BATCHFORMAT.lower()
+
+# undeliverable cdr are appended to spool segments, then replayed to endpoints at CDRSPOOL_REPLAYRATE cdr per second (0 to disable)
+_CDRSPOOL_REPLAYRATE = os.getenv('CDRSPOOL_REPLAYRATE')
+CDRSPOOL_REPLAYRATE = 10
+if _CDRSPOOL_REPLAYRATE and _CDRSPOOL_REPLAYRATE.isdigit():
+    CDRSPOOL_REPLAYRATE = int(_CDRSPOOL_REPLAYRATE)
+
+# spool segment is rotated once it reach CDRSPOOL_SEGMENTSIZE megabyte
+_CDRSPOOL_SEGMENTSIZE = os.getenv('CDRSPOOL_SEGMENTSIZE')
+CDRSPOOL_SEGMENTSIZE = 64
+if _CDRSPOOL_SEGMENTSIZE and _CDRSPOOL_SEGMENTSIZE.isdigit() and int(_CDRSPOOL_SEGMENTSIZE) > 0:
+    CDRSPOOL_SEGMENTSIZE = int(_CDRSPOOL_SEGMENTSIZE)
+
+# uuid of cdr acknowledged by endpoints are remembered CDRDEDUP_WINDOW second, up to CDRDEDUP_MAXSIZE uuid, so they are never sent again
+_CDRDEDUP_WINDOW = os.getenv('CDRDEDUP_WINDOW')
+CDRDEDUP_WINDOW = 21600
+if _CDRDEDUP_WINDOW and _CDRDEDUP_WINDOW.isdigit():
+    CDRDEDUP_WINDOW = int(_CDRDEDUP_WINDOW)
+
+_CDRDEDUP_MAXSIZE = os.getenv('CDRDEDUP_MAXSIZE')
+CDRDEDUP_MAXSIZE = 500000
+if _CDRDEDUP_MAXSIZE and _CDRDEDUP_MAXSIZE.isdigit():
+    CDRDEDUP_MAXSIZE = int(_CDRDEDUP_MAXSIZE)
 #-----------------------------------------------------------------------------------------------------
 # CDR FILE
 #-----------------------------------------------------------------------------------------------------
@@ -149,8 +231,168 @@ CDRFNAME_FMT = os.getenv('CDRFNAME_FMT')
 if not CDRFNAME_FMT:
     CDRFNAME_FMT = '%Y-%m-%d.cdr.nice'
 
+# cdr file writer group commit: flush and fsync every DISKCDR_FLUSHINTERVAL millisecond or DISKCDR_FLUSHSIZE kilobyte
+_DISKCDR_FLUSHINTERVAL = os.getenv('DISKCDR_FLUSHINTERVAL')
+DISKCDR_FLUSHINTERVAL = 200
+if _DISKCDR_FLUSHINTERVAL and _DISKCDR_FLUSHINTERVAL.isdigit():
+    DISKCDR_FLUSHINTERVAL = int(_DISKCDR_FLUSHINTERVAL)
+
+_DISKCDR_FLUSHSIZE = os.getenv('DISKCDR_FLUSHSIZE')
+DISKCDR_FLUSHSIZE = 1024
+if _DISKCDR_FLUSHSIZE and _DISKCDR_FLUSHSIZE.isdigit() and int(_DISKCDR_FLUSHSIZE) > 0:
+    DISKCDR_FLUSHSIZE = int(_DISKCDR_FLUSHSIZE)
+
+# cdr file compression: none, gzip or zstd, each group commit is written as a standalone frame
+DISKCDR_COMPRESSION = 'none'
+_DISKCDR_COMPRESSION = os.getenv('DISKCDR_COMPRESSION')
+if _DISKCDR_COMPRESSION and _DISKCDR_COMPRESSION.lower() in ['none', 'gzip', 'zstd']:
+    DISKCDR_COMPRESSION = _DISKCDR_COMPRESSION.lower()
+
 # life time for CDR
 _CDRTTL = os.getenv('CDRTTL')
 CDRTTL = 8080
 if _CDRTTL and _CDRTTL.isdigit():
     CDRTTL = int(_CDRTTL)
+
+#-----------------------------------------------------------------------------------------------------
+# CDR ENGINE
+#-----------------------------------------------------------------------------------------------------
+# thread: pool of worker threads, asyncio: single thread event loop
+CDR_ENGINE = 'thread'
+_CDR_ENGINE = os.getenv('CDR_ENGINE')
+if _CDR_ENGINE and _CDR_ENGINE.lower() in ['thread', 'asyncio']:
+    CDR_ENGINE = _CDR_ENGINE.lower()
+
+# max cdr being delivered at the same time by asyncio engine
+_CDR_ASYNC_INFLIGHT = os.getenv('CDR_ASYNC_INFLIGHT')
+CDR_ASYNC_INFLIGHT = 2000
+if _CDR_ASYNC_INFLIGHT and _CDR_ASYNC_INFLIGHT.isdigit() and int(_CDR_ASYNC_INFLIGHT) > 0:
+    CDR_ASYNC_INFLIGHT = int(_CDR_ASYNC_INFLIGHT)
+
+# number of worker processes the cdr are sharded to by uuid hash, 0 keep them in liberator process (list transport only)
+_CDR_PROCESSES = os.getenv('CDR_PROCESSES')
+CDR_PROCESSES = 0
+if _CDR_PROCESSES and _CDR_PROCESSES.isdigit():
+    CDR_PROCESSES = int(_CDR_PROCESSES)
+
+# list: cdr:queue:new with cdr:detail:{uuid}, stream: cdr:stream read by consumer group
+# must be the same value as callng
+CDR_TRANSPORT = 'list'
+_CDR_TRANSPORT = os.getenv('CDR_TRANSPORT')
+if _CDR_TRANSPORT and _CDR_TRANSPORT.lower() in ['list', 'stream']:
+    CDR_TRANSPORT = _CDR_TRANSPORT.lower()
+
+CDR_STREAM_GROUP = os.getenv('CDR_STREAM_GROUP')
+if not CDR_STREAM_GROUP:
+    CDR_STREAM_GROUP = 'liberator'
+
+# second, entry pending longer than this in a consumer is claimed by another one
+# keep it above the longest delivery retry time
+_CDR_STREAM_CLAIMIDLE = os.getenv('CDR_STREAM_CLAIMIDLE')
+CDR_STREAM_CLAIMIDLE = 3600
+if _CDR_STREAM_CLAIMIDLE and _CDR_STREAM_CLAIMIDLE.isdigit() and int(_CDR_STREAM_CLAIMIDLE) > 0:
+    CDR_STREAM_CLAIMIDLE = int(_CDR_STREAM_CLAIMIDLE)
+
+# max uuid taken from cdr:queue:new per redis round trip
+_CDRINGEST_BATCHSIZE = os.getenv('CDRINGEST_BATCHSIZE')
+CDRINGEST_BATCHSIZE = 100
+if _CDRINGEST_BATCHSIZE and _CDRINGEST_BATCHSIZE.isdigit() and int(_CDRINGEST_BATCHSIZE) > 0:
+    CDRINGEST_BATCHSIZE = int(_CDRINGEST_BATCHSIZE)
+
+# raw cdr files written by callng while redis was unreachable are scanned every CDRBACKFILL_INTERVAL second (0 to disable)
+_CDRBACKFILL_INTERVAL = os.getenv('CDRBACKFILL_INTERVAL')
+CDRBACKFILL_INTERVAL = 10
+if _CDRBACKFILL_INTERVAL and _CDRBACKFILL_INTERVAL.isdigit():
+    CDRBACKFILL_INTERVAL = int(_CDRBACKFILL_INTERVAL)
+
+# at-least-once queue: uuid is moved to a per consumer processing list until it is delivered,
+# and unfinished ones are requeued at startup
+_CDRQUEUE_RELIABLE = os.getenv('CDRQUEUE_RELIABLE')
+CDRQUEUE_RELIABLE = False
+if _CDRQUEUE_RELIABLE and _CDRQUEUE_RELIABLE.upper() in ['TRUE', '1', 'YES']:
+    CDRQUEUE_RELIABLE = True
+
+# on shutdown, cdr in hand are delivered or spooled for up to CDR_DRAIN_TIMEOUT second, the rest is handed back to redis
+_CDR_DRAIN_TIMEOUT = os.getenv('CDR_DRAIN_TIMEOUT')
+CDR_DRAIN_TIMEOUT = 10
+if _CDR_DRAIN_TIMEOUT and _CDR_DRAIN_TIMEOUT.isdigit():
+    CDR_DRAIN_TIMEOUT = int(_CDR_DRAIN_TIMEOUT)
+
+# consumer identity of reliable queue and stream consumer group, must be stable over restart and unique per liberator
+CDR_CONSUMERID = os.getenv('CDR_CONSUMERID')
+if not CDR_CONSUMERID:
+    CDR_CONSUMERID = os.getenv('NODEID') or socket.gethostname()
+
+# delivered cdr are removed from redis by batch, every CDRCLEAN_INTERVAL millisecond or CDRCLEAN_BATCHSIZE cdr
+_CDRCLEAN_INTERVAL = os.getenv('CDRCLEAN_INTERVAL')
+CDRCLEAN_INTERVAL = 10
+if _CDRCLEAN_INTERVAL and _CDRCLEAN_INTERVAL.isdigit():
+    CDRCLEAN_INTERVAL = int(_CDRCLEAN_INTERVAL)
+
+_CDRCLEAN_BATCHSIZE = os.getenv('CDRCLEAN_BATCHSIZE')
+CDRCLEAN_BATCHSIZE = 500
+if _CDRCLEAN_BATCHSIZE and _CDRCLEAN_BATCHSIZE.isdigit() and int(_CDRCLEAN_BATCHSIZE) > 0:
+    CDRCLEAN_BATCHSIZE = int(_CDRCLEAN_BATCHSIZE)
+
+# number of threads that refine and deliver cdr
+_CDRWORKER_POOLSIZE = os.getenv('CDRWORKER_POOLSIZE')
+CDRWORKER_POOLSIZE = 16
+if _CDRWORKER_POOLSIZE and _CDRWORKER_POOLSIZE.isdigit() and int(_CDRWORKER_POOLSIZE) > 0:
+    CDRWORKER_POOLSIZE = int(_CDRWORKER_POOLSIZE)
+
+# in-memory cdr waiting for a worker, cdr master stop consuming redis queue when it is full
+_CDRWORKER_QUEUESIZE = os.getenv('CDRWORKER_QUEUESIZE')
+CDRWORKER_QUEUESIZE = 1000
+if _CDRWORKER_QUEUESIZE and _CDRWORKER_QUEUESIZE.isdigit() and int(_CDRWORKER_QUEUESIZE) > 0:
+    CDRWORKER_QUEUESIZE = int(_CDRWORKER_QUEUESIZE)
+
+# cdr fan-out, comma separated sinks among http, file, sqlite, syslog with slash separated options, eg:
+# http/mandatory/concurrency=16/retry=5,file/mandatory,sqlite,syslog
+# redis is cleaned once every mandatory sink acknowledged, empty to keep http delivery with file fallback
+CDR_SINKS = []
+_CDR_SINKS = os.getenv('CDR_SINKS')
+if _CDR_SINKS:
+    for _sinkspec in _CDR_SINKS.split(','):
+        _sinkopts = _sinkspec.strip().lower().split('/')
+        if _sinkopts[0] not in ['http', 'file', 'sqlite', 'syslog']: continue
+        _sink = {'name': _sinkopts[0], 'mandatory': False}
+        for _sinkopt in _sinkopts[1:]:
+            if _sinkopt == 'mandatory': _sink['mandatory'] = True
+            elif '=' in _sinkopt:
+                _key, _value = _sinkopt.split('=', 1)
+                if _key in ['concurrency', 'retry', 'queuesize', 'batchsize'] and _value.isdigit() and int(_value) > 0:
+                    _sink[_key] = int(_value)
+        CDR_SINKS.append(_sink)
+
+CDR_SQLITE_PATH = os.getenv('CDR_SQLITE_PATH')
+if not CDR_SQLITE_PATH:
+    CDR_SQLITE_PATH = f'{LOGDIR}/cdr/cdr.sqlite'
+
+# unix socket path or host:port of udp syslog server
+CDR_SYSLOG_ADDRESS = os.getenv('CDR_SYSLOG_ADDRESS')
+if not CDR_SYSLOG_ADDRESS:
+    CDR_SYSLOG_ADDRESS = '/dev/log'
+
+# legs of a call are held until none arrived for CDRJOIN_WINDOW second, then reach the sinks as one session record, 0 disable the join
+_CDRJOIN_WINDOW = os.getenv('CDRJOIN_WINDOW')
+CDRJOIN_WINDOW = 0
+if _CDRJOIN_WINDOW and _CDRJOIN_WINDOW.isdigit():
+    CDRJOIN_WINDOW = int(_CDRJOIN_WINDOW)
+
+# max sessions held by the join, the least recently updated one is sent as is beyond
+_CDRJOIN_MAXSIZE = os.getenv('CDRJOIN_MAXSIZE')
+CDRJOIN_MAXSIZE = 100000
+if _CDRJOIN_MAXSIZE and _CDRJOIN_MAXSIZE.isdigit() and int(_CDRJOIN_MAXSIZE) > 0:
+    CDRJOIN_MAXSIZE = int(_CDRJOIN_MAXSIZE)
+
+# minutes of per-interconnection and per-gateway kpi kept in redis, 0 disable the aggregation
+_CDRKPI_WINDOW = os.getenv('CDRKPI_WINDOW')
+CDRKPI_WINDOW = 60
+if _CDRKPI_WINDOW and _CDRKPI_WINDOW.isdigit():
+    CDRKPI_WINDOW = int(_CDRKPI_WINDOW)
+
+# second between two additions of the kpi counters to redis
+_CDRKPI_INTERVAL = os.getenv('CDRKPI_INTERVAL')
+CDRKPI_INTERVAL = 5
+if _CDRKPI_INTERVAL and _CDRKPI_INTERVAL.isdigit() and int(_CDRKPI_INTERVAL) > 0:
+    CDRKPI_INTERVAL = int(_CDRKPI_INTERVAL)
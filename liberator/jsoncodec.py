@@ -0,0 +1,85 @@
+#
+# liberator:jsoncodec.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+
+import json
+from utilities import logger
+
+# every backend produce compact json in utf-8 without ascii escaping and decode to the same document:
+#   - integer of any size is kept as is, number key is written as string
+#   - a float in exponent form is 1e20, 1e-7 with orjson and msgspec and 1e+20, 1e-07 with the stdlib, same value
+#   - NaN and Infinity are written as null by orjson and msgspec and as is by the stdlib, decoding refuse them
+#     as it refuse a number that overflow a double
+# msgspec is in requirements.txt, the stdlib is only the fallback of a build without it and of what orjson refuse
+# document are dict with str or number key, list, tuple, str, int, float, bool and None, as cdr are,
+# other types such as bytes, set or datetime are refused by the stdlib but some backends take them
+
+def _stdlibdumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def _parseconstant(constant):
+    raise ValueError(f'{constant} is not valid JSON')
+
+
+def _parsefloat(text):
+    number = float(text)
+    if number in (float('inf'), float('-inf')):
+        raise ValueError(f'number is infinity when parsed as double: {text}')
+    return number
+
+
+def _stdlibloads(data):
+    return json.loads(data, parse_constant=_parseconstant, parse_float=_parsefloat)
+
+
+# name, dumps and loads of each backend, by preference; a backend without loads is used for encoding only
+_backends = []
+# exception raised by loads on invalid document, whatever backend is used
+DecodeError = (ValueError,)
+try:
+    import orjson
+    def _orjsondumps(obj):
+        # orjson refuse integer beyond 64 bits and a few types the stdlib take, the stdlib decide
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return _stdlibdumps(obj)
+    # orjson decode integer beyond 64 bits as float
+    _backends.append(('orjson', _orjsondumps, None))
+except ImportError:
+    pass
+try:
+    import msgspec
+    _backends.append(('msgspec', msgspec.json.Encoder().encode, msgspec.json.Decoder().decode))
+    DecodeError = (ValueError, msgspec.DecodeError)
+except ImportError:
+    pass
+_backends.append(('stdlib', _stdlibdumps, _stdlibloads))
+
+# sample that cover what a cdr carry, a backend that does not encode or decode it as stdlib does is not used for that
+_SELFCHECK = [{'uuid': '6f1b0b5e-5c5e-4d3b-9a57-3c1f0e2d1a00', 'duration': '60', 'status': None, 'caller_name': 'Nguyễn "Minh" \\ \t\n \x7f\x1f',
+               'count': 12, 'ratio': 0.25, 'rtp_crypto': True, 'codecs': ['PCMA', 'PCMU'], 'extra': {}},
+              [], [123456.0, -0.0, 0.000125, 2**64, -2**63 - 1]]
+
+
+def _selfcheck(backend, operation, function):
+    try:
+        if operation == 'dumps' and all(function(sample) == _stdlibdumps(sample) for sample in _SELFCHECK):
+            return True
+        if operation == 'loads' and all(function(_stdlibdumps(sample)) == _stdlibloads(_stdlibdumps(sample)) for sample in _SELFCHECK):
+            return True
+    except Exception as e:
+        pass
+    logger.warning(f"module=liberator, space=jsoncodec, action=selfcheck, backend={backend}, operation={operation}, state=mismatched")
+    return False
+
+
+# dumps return bytes, loads accept str or bytes
+ENCODER, dumps = next((backend, _dumps) for backend, _dumps, _loads in _backends if _selfcheck(backend, 'dumps', _dumps))
+DECODER, loads = next((backend, _loads) for backend, _dumps, _loads in _backends if _loads and _selfcheck(backend, 'loads', _loads))
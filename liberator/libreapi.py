@@ -25,8 +25,9 @@ from fastapi import APIRouter, Response, Path, Query
 from fastapi.encoders import jsonable_encoder
 from configuration import (_APPLICATION, _SWVERSION, _DESCRIPTION, CHANGE_CFG_CHANNEL, SECURITY_CHANNEL,
                            SWCODECS, DFT_CLUSTER_ATTRS, _BUILTIN_ACLS_,
-                           REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, SCAN_COUNT, LOGDIR)
-from utilities import logger, get_request_uuid, redishash, jsonhash, fieldjsonify, fieldredisify, listify, stringify, getaname, removekey, isjson
+                           REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASSWORD, SCAN_COUNT, LOGDIR, CDRKPI_WINDOW)
+from utilities import logger, get_request_uuid, redishash, jsonhash, fieldjsonify, fieldredisify, listify, stringify, getaname, removekey, isjson, CDRSUFFIXES, cdrlines
+import jsoncodec
 
 REDIS_CONNECTION_POOL = redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, password=REDIS_PASSWORD,
                                                      decode_responses=True, max_connections=10, timeout=5)
@@ -3005,16 +3006,20 @@ def get_cdr_records(response: Response, date: str = Query(None), limit: int = Qu
         else:
             datetime.strptime(date, '%Y-%m-%d')
 
-        cdr_file = os.path.join(LOGDIR, 'cdr', f'{date}.cdr.nice.json')
+        # the day may be written plain and compressed if compression setting was changed, and by each cdr worker process
+        suffixes = '|'.join(map(re.escape, CDRSUFFIXES.values()))
+        cdr_name = re.compile(rf'{re.escape(date)}\.cdr\.nice(\.[0-9]+)?\.json({suffixes})')
+        cdr_dir = os.path.join(LOGDIR, 'cdr')
         legs = []
-        if os.path.isfile(cdr_file):
-            with open(cdr_file, 'r') as f:
-                for line in f:
+        for filename in sorted(os.listdir(cdr_dir) if os.path.isdir(cdr_dir) else []):
+            cdr_file = os.path.join(cdr_dir, filename)
+            if cdr_name.fullmatch(filename) and os.path.isfile(cdr_file):
+                for line in cdrlines(cdr_file):
                     line = line.strip()
                     if line:
                         try:
-                            legs.append(json.loads(line))
-                        except json.JSONDecodeError:
+                            legs.append(jsoncodec.loads(line))
+                        except jsoncodec.DecodeError:
                             pass
 
         # group by seshid — merge inbound + outbound into one session record
@@ -3062,3 +3067,48 @@ def get_cdr_records(response: Response, date: str = Query(None), limit: int = Qu
         logger.error(f"module=liberator, space=libreapi, action=get_cdr_records, requestid={get_request_uuid()}, exception={e}, traceback={traceback.format_exc()}")
 
     return result
+
+
+class KPIKindEnum(str, Enum):
+    intcon = 'intcon'
+    gateway = 'gateway'
+
+@librerouter.get("/libreapi/cdr/kpi", status_code=200)
+def get_cdr_kpi(response: Response, kind: KPIKindEnum = Query(KPIKindEnum.intcon), name: str = Query(None), minutes: int = Query(15, ge=1, le=1440)):
+    try:
+        # per minute counters are added up in redis by cdr engine of every liberator
+        current = int(time.time())//60
+        minutes = min(minutes, CDRKPI_WINDOW)
+        if name: names = [name]
+        else: names = rdbconn.zrangebyscore(f'kpi:{kind.value}', current - minutes + 1, '+inf')
+        pipe = rdbconn.pipeline(transaction=False)
+        for _name in names:
+            for minute in range(current - minutes + 1, current + 1):
+                pipe.hgetall(f'kpi:{kind.value}:{_name}:{minute}')
+        details = pipe.execute()
+
+        result = []
+        for index, _name in enumerate(names):
+            counters = {}
+            for bucket in details[index*minutes:(index+1)*minutes]:
+                for field, value in bucket.items():
+                    counters[field] = counters.get(field, 0) + int(value)
+            attempts, answered = counters.get('attempts', 0), counters.get('answered', 0)
+            if not attempts: continue
+            result.append({
+                'name': _name,
+                'attempts': attempts,
+                'answered': answered,
+                'asr': round(answered*100/attempts, 2),
+                'acd': round(counters.get('billsec', 0)/answered, 1) if answered else None,
+                'ner': round(counters.get('effective', 0)*100/attempts, 2),
+                'pdd': round(counters['pddsum']/counters['pddcount']) if counters.get('pddcount') else None,
+                'hangup_causes': {field[6:]: value for field, value in counters.items() if field.startswith('cause:')},
+            })
+        result.sort(key=lambda kpi: kpi['attempts'], reverse=True)
+        response.status_code = 200
+    except Exception as e:
+        response.status_code, result = 500, None
+        logger.error(f"module=liberator, space=libreapi, action=get_cdr_kpi, requestid={get_request_uuid()}, exception={e}, traceback={traceback.format_exc()}")
+
+    return result
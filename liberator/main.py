@@ -12,21 +12,22 @@ import threading
 import uvicorn
 from configuration import (
     REDIS_HOST, REDIS_PORT, REDIS_PASSWORD, REDIS_DB, HTTPCDR_ENDPOINTS, DISKCDR_ENABLE, CDRFNAME_INTERVAL, CDRFNAME_FMT,
-    HTTP_API_LISTEN_IP, HTTP_API_LISTEN_PORT,
+    HTTP_API_LISTEN_IP, HTTP_API_LISTEN_PORT, CDR_ENGINE, CDR_TRANSPORT, CDR_DRAIN_TIMEOUT, CDR_PROCESSES,
 )
 from utilities import logger
 from basemgr import BaseEventHandler, SecurityEventHandler, basestartup
-from cdr import CDRMaster
+from cdr import CDRMaster, CDRStreamMaster
 
 #---------------------------------------------------------------------------------------------------------------------------
 # MAIN APPLICATION
 #---------------------------------------------------------------------------------------------------------------------------
 if __name__ == '__main__':
+    cdrthread = None
     try:
         logger.debug(
             f'''module=liberator, space=main, action=initialize, REDIS_HOST={REDIS_HOST}, REDIS_PORT={REDIS_PORT}'''
             f''', REDIS_PASSWORD={str(REDIS_PASSWORD)[:3]}*, REDIS_DB={REDIS_DB}, HTTPCDR_ENDPOINTS={HTTPCDR_ENDPOINTS}'''
-            f''', DISKCDR_ENABLE={DISKCDR_ENABLE}, CDRFNAME_INTERVAL={CDRFNAME_INTERVAL}, CDRFNAME_FMT={CDRFNAME_FMT}'''
+            f''', DISKCDR_ENABLE={DISKCDR_ENABLE}, CDRFNAME_INTERVAL={CDRFNAME_INTERVAL}, CDRFNAME_FMT={CDRFNAME_FMT}, CDR_ENGINE={CDR_ENGINE}, CDR_TRANSPORT={CDR_TRANSPORT}, CDR_PROCESSES={CDR_PROCESSES}'''
         )
         # EVENT HANDLER
         basestartup()
@@ -35,7 +36,16 @@ if __name__ == '__main__':
         secthread = SecurityEventHandler()
         secthread.start()
         # CDR HANDLER
-        cdrthread = CDRMaster()
+        if CDR_PROCESSES and CDR_TRANSPORT == 'list':
+            from cdrprocess import CDRProcessMaster
+            cdrthread = CDRProcessMaster(CDR_PROCESSES)
+        elif CDR_ENGINE == 'asyncio':
+            from cdrasync import AsyncCDRMaster
+            cdrthread = AsyncCDRMaster()
+        elif CDR_TRANSPORT == 'stream':
+            cdrthread = CDRStreamMaster()
+        else:
+            cdrthread = CDRMaster()
         cdrthread.start()
         # HTTP API
         uvicorn.run('api:httpapi', host=HTTP_API_LISTEN_IP, port=HTTP_API_LISTEN_PORT, workers=4, access_log=False)
@@ -43,6 +53,9 @@ if __name__ == '__main__':
         logger.critical(f'module=liberator, space=main, exception: {e}, traceback: {traceback.format_exc()}')
     finally:
         logger.debug('module=liberator, space=main, action=liberator_stopping')
+        # cdr engine finish the cdr in hand before the threads are told to stop, unless it never started or already died
+        if cdrthread and cdrthread.is_alive():
+            cdrthread.drain(CDR_DRAIN_TIMEOUT)
         for thrd in threading.enumerate():
             thrd.stop = True
             logger.info(f'module=liberator, space=main, action=teardown, id={thrd.ident}, name={thrd.name}')
@@ -0,0 +1,116 @@
+#
+# liberator:tests/test_jsoncodec.py
+#
+# The Initial Developer of the Original Code is
+# Minh Minh <hnimminh at[@] outlook dot[.] com>
+# Portions created by the Initial Developer are Copyright (C) the Initial Developer.
+# All Rights Reserved.
+#
+# python3 -m unittest discover -s liberator/tests  or  python3 -m pytest liberator/tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import jsoncodec
+
+
+# cdr:detail as callng write it, every variable is a string
+DETAIL = {
+    'core-uuid': '1c2a0e3d-8f6b-4d0e-9d7e-3b5c1a2f4e60',
+    'switchname': 'libresbc',
+    'channel_data': {'state': 'CS_REPORTING', 'direction': 'inbound', 'state_number': '11'},
+    'variables': {
+        'uuid': '6f1b0b5e-5c5e-4d3b-9a57-3c1f0e2d1a00',
+        'x-seshid': 'b5c2a0e4-1f3d-4a6b-8c7e-9d0f1a2b3c4d',
+        'sip_call_id': '5f3a1b2c@10.0.0.1',
+        'caller_id_name': 'Nguyễn Văn "Minh" \\ 王小明 😀',
+        'caller_id_number': '+84901234567',
+        'destination_number': '18005550100',
+        'start_epoch': '1700000000', 'answer_epoch': '1700000005', 'end_epoch': '1700000065',
+        'billsec': '60', 'hangup_cause': 'NORMAL_CLEARING', 'sip_hangup_disposition': 'send_bye',
+        'sip_user_agent': 'Softphone/1.0 (\t\n\x00\x1f\x7f )',
+        'rtp_use_codec_string': 'PCMA,PCMU,G729',
+    },
+    'callflow': [{'dialplan': 'XML', 'profile_index': '1', 'extension': {'name': 'inbound', 'number': '18005550100'}}],
+}
+
+# refined leg, as the sinks post it
+RECORD = {
+    'uuid': '6f1b0b5e-5c5e-4d3b-9a57-3c1f0e2d1a00', 'seshid': 'b5c2a0e4-1f3d-4a6b-8c7e-9d0f1a2b3c4d',
+    'direction': 'inbound', 'sipprofile': 'public', 'context': 'core', 'nodeid': 'node-01', 'intconname': 'carrier-é',
+    'gateway': None, 'caller_name': 'Nguyễn', 'caller_number': '+84901234567', 'destination_number': '18005550100',
+    'start_time': 1700000000, 'answer_time': 1700000005, 'end_time': 1700000065, 'duration': 60,
+    'rtp_crypto': True, 'srtp': False, 'mos': 4.41, 'jitter': 0.000125, 'loss': 0.0,
+}
+
+# numbers at the edges of what the backends do differently
+NUMBERS = [0, -1, 2**53, 2**63 - 1, 2**63, 2**64 - 1, 2**64, -2**63, -2**63 - 1, 10**40, -10**40,
+           0.1, -0.0, 1.0, 123456.0, 1e15, 1e16, 1e20, 1e21, 1e22, 1e-7, 1.5e300, 5e-324, 1.7976931348623157e308, 0.000123]
+
+
+class JSONCodecTest(unittest.TestCase):
+    """ every available backend against the stdlib encoding """
+
+    def test_backends(self):
+        names = [backend for backend, dumps, loads in jsoncodec._backends]
+        self.assertEqual(names[-1], 'stdlib')
+        self.assertIn(jsoncodec.ENCODER, names)
+        self.assertIn(jsoncodec.DECODER, names)
+
+    def test_format(self):
+        for backend, dumps, loads in jsoncodec._backends:
+            with self.subTest(backend=backend):
+                self.assertEqual(dumps({'a': 'é', 'b': [1, None, True, False], 'c': {}}), '{"a":"é","b":[1,null,true,false],"c":{}}'.encode())
+                self.assertEqual(dumps(['\t\n\x00\x1f\x7f"\\']), b'["\\t\\n\\u0000\\u001f\x7f\\"\\\\"]')
+                self.assertEqual(dumps([123456.0, -0.0, 0.000125, 1e15]), b'[123456.0,-0.0,0.000125,1000000000000000.0]')
+                self.assertEqual(dumps([2**64, -2**63 - 1]), b'[18446744073709551616,-9223372036854775809]')
+                self.assertEqual(dumps({1: 'a', 2**64: 'c'}), b'{"1":"a","18446744073709551616":"c"}')
+
+    def test_identical(self):
+        # float in exponent form is spelled differently by the stdlib
+        plain = [number for number in NUMBERS if 'e' not in repr(number)]
+        documents = [DETAIL, RECORD, [RECORD, RECORD], {'seshid': RECORD['seshid'], 'legs': [RECORD, RECORD]}, plain,
+                     {'numbers': plain}, (1, 'a'), '', 'Nguyễn', 0, None, [], {}]
+        for backend, dumps, loads in jsoncodec._backends:
+            with self.subTest(backend=backend):
+                for document in documents:
+                    self.assertEqual(dumps(document), jsoncodec._stdlibdumps(document))
+                decoded = jsoncodec._stdlibloads(dumps(NUMBERS))
+                self.assertEqual([(type(number), number) for number in decoded], [(type(number), number) for number in NUMBERS])
+
+    def test_roundtrip(self):
+        for backend, dumps, loads in jsoncodec._backends:
+            if not loads: continue
+            with self.subTest(backend=backend):
+                for document in [DETAIL, RECORD, [RECORD, RECORD], NUMBERS]:
+                    encoded = jsoncodec._stdlibdumps(document)
+                    self.assertEqual(loads(encoded), document)
+                    self.assertEqual(loads(encoded.decode()), document)
+                for number in NUMBERS:
+                    decoded = loads(jsoncodec._stdlibdumps(number))
+                    self.assertEqual((type(decoded), decoded), (type(number), number))
+                # long digits inside a string are not number
+                self.assertEqual(loads('{"callid":"123456789012345678901234"}'), {'callid': '123456789012345678901234'})
+
+    def test_refused(self):
+        for backend, dumps, loads in jsoncodec._backends:
+            with self.subTest(backend=backend):
+                for encoded in [b'NaN', b'[Infinity]', b'[-Infinity]', b'1e400', b'[-1e400]', b'{"a":1', b'', b'\xff', b'[1,]']:
+                    if not loads: break
+                    with self.assertRaises(jsoncodec.DecodeError):
+                        loads(encoded)
+                for document in [{('a',): 1}, {'a': object()}, [object()]]:
+                    with self.assertRaises(TypeError):
+                        dumps(document)
+                with self.assertRaises(ValueError):
+                    dumps('\ud800')
+
+    def test_selected(self):
+        self.assertEqual(jsoncodec.dumps(DETAIL), jsoncodec._stdlibdumps(DETAIL))
+        self.assertEqual(jsoncodec.loads(jsoncodec.dumps(RECORD)), RECORD)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,9 @@
 # All Rights Reserved.
 #
 import os
+import io
 import sys
+import gzip
 import json
 import time
 import random
@@ -15,6 +17,7 @@ import logging
 from logging.handlers import TimedRotatingFileHandler, SysLogHandler
 from threading import Thread
 from contextvars import ContextVar
+import zstandard
 from configuration import LOGDIR, LOGSTACKS, LOGLEVEL
 
 # delimiter for data transformation
@@ -188,6 +191,32 @@ def removekey(keys, data):
 def randomstr(size=8, chars='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789abcdefghijklmnopqrstuvwxyz'):
     return ''.join(random.choice(chars) for _ in range(size))
 
+#-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# cdr archive, every flush is compressed as an independent gzip member or zstd frame
+CDRSUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+def cdrcompressor(compression):
+    if compression == 'gzip':
+        return lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress
+    return lambda data: data
+
+def cdrlines(filepath):
+    # stream the lines of a cdr file whatever its compression, a frame being written at the end is skipped
+    if filepath.endswith('.gz'):
+        reader = gzip.open(filepath, 'rt')
+    elif filepath.endswith('.zst'):
+        reader = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), read_across_frames=True, closefd=True))
+    else:
+        reader = open(filepath, 'r')
+    with reader:
+        try:
+            for line in reader:
+                if line.endswith('\n'): yield line
+        except (EOFError, zstandard.ZstdError):
+            pass
+
 #-----------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 def threaded(func):
     def wrapper(*args, **kwargs):